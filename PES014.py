@@ -20,17 +20,21 @@ called 'properties' with some useful tools and information about how we want you
 """
 """ NeuroLake imports """
 # from utils.HydraBase import hydra_query, hydra_tester
-# import utils.Lake_Exceptions as Exceptions
+import utils.Lake_Exceptions as Exceptions
+import utils.Lake_Retry as Retry
+import utils.Lake_Metrics as Metrics
+import utils.Lake_Cache as Cache
+import utils.Lake_Throttle as Throttle
+import utils.Lake_Imports as Imports
 # import utils.Lake_Enum as Enums
-import requests
-import lxml.html
 import urllib
-try:
-    import Image
-except ImportError:
-    from PIL import Image
-import pytesseract
-import cv2
+import urllib.parse
+# Heavy dependencies are imported on first use, see utils.Lake_Imports
+Transport = Imports.lazy_import("utils.Lake_Transport")
+requests = Imports.lazy_import("requests")
+lxml = Imports.lazy_import("lxml", submodules=("html", "etree"))
+cv2 = Imports.lazy_import("cv2")
+np = Imports.lazy_import("numpy")
 
 """You should need at least these imports"""
 import json
@@ -39,16 +43,83 @@ import sys
 import os
 import json
 """Your own imports go down here"""
+import tools.captcha.ocr_engines as OcrEngines
+import tools.captcha.digit_classifier as DigitClassifier
+import uuid
+import functools
+import threading
+import collections
+import concurrent.futures
 
+CAPTCHA_LENGTH = 5
+
+# Preprocessing variants read in parallel by solve_captcha. The first one is the default preprocessing
+CAPTCHA_VARIANTS = [
+    {"threshold": 80, "blur_size": 3, "dilate_size": 0},
+    {"threshold": 60, "blur_size": 3, "dilate_size": 0},
+    {"threshold": 110, "blur_size": 3, "dilate_size": 0},
+    {"threshold": 80, "blur_size": 1, "dilate_size": 0},
+    {"threshold": 80, "blur_size": 5, "dilate_size": 0},
+    {"threshold": 80, "blur_size": 3, "dilate_size": 3},
+]
+
+captcha_stats = {"solves": 0, "refetches": 0, "refetches_avoided": 0, "low_confidence_drops": 0,
+                 "submits": 0, "submits_accepted": 0, "submits_rejected": 0}
+# Names under which the captcha counters are exported by utils.Lake_Metrics
+CAPTCHA_METRIC_EVENTS = {"solves": "ocr_attempts", "submits_rejected": "captcha_rejections"}
+_captcha_lock = threading.Lock()
+_ocr_pool = None
+
+# Properties needed to solve a captcha, see solve_captcha_content
+CAPTCHA_PROPERTIES = ["ocr_backend", "digit_model", "digit_min_confidence", "captcha_variants", "ocr_workers",
+                      "min_captcha_confidence"]
+
+DEFAULT_RETRY_POLICY = Retry.RetryPolicy()
+
+# History rows of a tracking_encomenda.php page are the rows with a <font> directly inside a cell (the header row has
+# its <font> inside <div><b>). The cells are date, time and status. Compiled on first use by compiled_xpath
+DETAIL_ROWS_XPATH = '//tr[td/font]'
+DETAIL_DATE_XPATH = 'td[1]/font/text()'
+DETAIL_STATUS_XPATH = 'td[3]/font/text()'
+
+# Last statuses after which a package history does not change anymore
+TERMINAL_STATUSES = ("ENTREGA REALIZADA",)
+
+# Maximum number of package detail pages fetched at the same time by a single query
+DETAIL_FANOUT = 8
+
+# The PES014_HOST environment variable points the query to another host, e.g. the local stand-in of tools/totalexpress_stub.py
+HOST = os.environ.get("PES014_HOST", "http://tracking.totalexpress.com.br")
 
 properties = {
-    "start_url": "http://tracking.totalexpress.com.br/tracking/0?cpf_cnpj",
-    "captcha_url": "http://tracking.totalexpress.com.br/images/imagem_verifica.php",
+    "start_url": HOST + "/tracking/0?cpf_cnpj",
+    "captcha_url": HOST + "/images/imagem_verifica.php",
     "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36",
     "content_type": "application/x-www-form-urlencoded",
-    "submit_url": "http://tracking.totalexpress.com.br/tracking/0",
-    "tracking_data_url": "http://tracking.totalexpress.com.br/tracking_encomenda.php?code="
+    "submit_url": HOST + "/tracking/0",
+    "tracking_data_url": HOST + "/tracking_encomenda.php?code=",
+    "ocr_backend": OcrEngines.AUTO_BACKEND,
+    "digit_model": DigitClassifier.DEFAULT_MODEL_PATH,
+    "digit_min_confidence": 0.2,
+    "captcha_samples_dir": None,
+    "captcha_variants": CAPTCHA_VARIANTS,
+    "ocr_workers": len(CAPTCHA_VARIANTS),
+    "min_captcha_confidence": 0.6,
+    "detail_fanout": DETAIL_FANOUT,
+    "connection_pool_size": 64,
+    "timeout": 15,
+    "retry_policy": Retry.RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=4.0, attempt_timeout=10.0),
+    "concurrency_controller": Throttle.AimdController(initial_limit=8, max_limit=64, slow_threshold=5.0),
+    "max_captcha_attempts": 20
 }
+
+def properties_for_host(host, base_properties=properties):
+    """Returns a copy of the query properties with every url pointing to `host` (scheme and authority, e.g. `http://127.0.0.1:8080`)"""
+    query_properties = dict(base_properties)
+    for key in ('start_url', 'captcha_url', 'submit_url', 'tracking_data_url'):
+        query_properties[key] = host + urllib.parse.urlsplit(base_properties[key])._replace(scheme='', netloc='').geturl()
+    return query_properties
+
 # @hydra_query
 def request(input_data, properties):
     """request method
@@ -56,162 +127,563 @@ def request(input_data, properties):
     :param: properties: Dictionaty containing execution properties such as selenium webdriver, Proxy configurations, IP configurations etc.
     :type input_data: dict
     :type properties: dict
-    :returns: dictionary containing the result of the query parsing"""
+    :returns: dictionary containing the result of the query parsing
 
-    query_result = {
-        "found_packages": False,
-        "total_packages": 0,
-        "packages": []
-    }
+    When `properties['result_cache']` holds a :class:`utils.Lake_Cache.ResultCache`, results are looked up and stored by `(cpf, cep)`. Found results expire after the cache TTL, so packages shipped later to the same cpf are picked up, and results without packages are not cached. The history of a package in a terminal state is cached without expiry, see :func:`fetch_result_packages`."""
+    cache = properties.get('result_cache')
+    if cache is not None:
+        cache_key = result_cache_key(input_data)
+        query_result = cache.get(cache_key)
+        if query_result is not None:
+            return query_result
 
-    request_session = requests.session()
-    
-    name = input_data.get("name")
-    cpf = input_data.get("cpf")
-    cep = input_data.get("cep")
+    with Metrics.span("query"):
+        query_result = _request(input_data, properties)
 
-    try:
-        i = 0
-        while True:
-            request_session.headers['User-Agent'] = properties['user_agent']
-            response = request_session.get(str(properties['start_url']))
-            if response.status_code == 200:
-                break
-            else:
-                time.sleep(0.5)
-                if i == 20: break
-                i = i + 1
-    except Exception as e:
-        raise(e)
+    if cache is not None and query_result["found_packages"]:
+        cache.put(cache_key, query_result)
+    return query_result
 
-    k = 0
-    while True:
-        result = get_capcha_string(properties['captcha_url'], request_session)
-        if result:
-            try:
-                if len(result) == 5:
-                    int(result)
-                    break
-                else:
-                    continue
-            except ValueError:
-                continue
-        else:
-            k = k + 1
-            if k == 20:
-                print("Failed get CAPTCHA code, I'll restart after 5 seconds")
-                time.sleep(5)
-                test_request(properties)
-                return query_result
-    
-    print("captcha: ", result)
 
-    request_payload = {
-        "nome_razao": name,
-        "cpf_cnpj" : cpf,
-        "cep" : cep,
-        "verificador": result,
-        "action": "pesquisar"
-    }
+def result_cache_key(input_data):
+    """Cache key of a lookup: the digits of its cpf and cep"""
+    return tuple("".join(filter(str.isdigit, str(input_data.get(field) or ""))) for field in ("cpf", "cep"))
 
-    headers = {
-        'Accept-Language': 'en-US,en;q=0.9,pt-BR,es',
-    }
-    request_session.headers = headers
+
+def is_terminal_package(package):
+    """True when the last status of the package is one of `TERMINAL_STATUSES`"""
+    return bool(package["status_list"]) and package["status_list"][-1]["status"].upper().startswith(TERMINAL_STATUSES)
+
+
+def _request(input_data, properties):
+    deadline = Retry.Deadline(properties.get('timeout'))
+    request_session, response_html = search(input_data, properties, deadline)
+    if response_html is None:
+        return build_query_result([])
+
+    query_result = build_query_result(fetch_result_packages(request_session, properties, response_html, deadline))
+    print("Success")
+    return query_result
+
+
+def search(input_data, properties, deadline=None):
+    """Opens a session, or takes a warm one from `properties['session_pool']`, and submits the search form until the host accepts a captcha.
+
+    :returns: tuple (request_session, parsed search result html). The html is None when the host rejected 3 captchas
+    """
+    # A warm session (see tools.batch.session_pool) already has the start page cookie and a solved captcha
+    warm_session = properties['session_pool'].acquire(deadline=deadline) if properties.get('session_pool') else None
+    if warm_session is not None:
+        request_session, result, captcha_content = warm_session.session, warm_session.captcha_text, warm_session.captcha_content
+    else:
+        request_session = open_session(properties, deadline)
+        result = None
 
     count = 0
     while True:
-        try:
-            i = 0
-            while True:
-                form_submit_response = request_session.post(properties['submit_url'], data=request_payload)
-                if form_submit_response.status_code == 200:
-                    response_html = lxml.html.fromstring(form_submit_response.content)
-                    break
-                else:
-                    if i == 20: 
-                        print("Can not access to: ", properties['submit_url'])
-                        sys.exit(0)
-                    i = i + 1
-        except Exception as e:
-            print(e)
-            sys.exit(0)
-
-        if "Ver Detalhes" in form_submit_response.text:
+        # A rejected verificador is never resubmitted, every submit uses a freshly solved captcha
+        if result is None:
+            result, captcha_content = solve_new_captcha(request_session, properties, deadline)
+
+        print("captcha: ", result)
+
+        accepted, response_html = submit_form(request_session, input_data, result, properties, deadline)
+        if accepted:
             print("Form submit success!")
-            break
+            if properties.get('captcha_samples_dir'):
+                save_captcha_sample(properties['captcha_samples_dir'], captcha_content, result)
+            return request_session, response_html
         else:
             error_message = response_html.xpath('//span[@class="erro"]/text()')
             print("Error Message: ", error_message[0])
             count = count + 1
             if count == 3:
-                return query_result
+                return request_session, None
             else:
+                result = None
                 continue
 
+
+def request_incremental(input_data, properties, previous_result):
+    """Polls a lookup again, fetching only the detail pages of the packages that were not in a terminal state in `previous_result`.
+
+    :param previous_result: A result returned by :func:`request`, or the previous result rebuilt with :func:`apply_delta`
+    :type previous_result: dict
+
+    :returns: delta dictionary with the keys of a query result, where `packages` only holds the packages with new status events, and only those events, plus `skipped_packages`, the ids of the terminal packages whose detail page was not fetched
+    """
+    with Metrics.span("query"):
+        deadline = Retry.Deadline(properties.get('timeout'))
+        request_session, response_html = search(input_data, properties, deadline)
+        if response_html is None:
+            return dict(build_query_result([]), skipped_packages=[])
+
+        data_codes, package_ids = parse_search_result(response_html)
+        previous_packages = {package["package_id"]: package for package in previous_result.get("packages", [])}
+        pending, skipped = [], []
+        for index, package_id in enumerate(package_ids):
+            if package_id in previous_packages and is_terminal_package(previous_packages[package_id]):
+                skipped.append(package_id)
+            else:
+                pending.append(index)
+        Metrics.increment("detail_fetches_skipped", len(skipped))
+        packages = fetch_package_details(request_session, properties, [data_codes[index] for index in pending],
+                                         [package_ids[index] for index in pending], deadline)
+
+    changed = []
+    for package in packages:
+        previous_package = previous_packages.get(package["package_id"])
+        new_events = new_status_events(previous_package["status_list"] if previous_package else [], package["status_list"])
+        if new_events:
+            changed.append(dict(package, status_list=new_events))
+    delta = build_query_result(changed)
+    delta.update({"found_packages": len(package_ids) > 0, "total_packages": len(package_ids), "skipped_packages": skipped})
+    return delta
+
+
+def new_status_events(previous_status_list, status_list):
+    """Returns the events of `status_list` missing from `previous_status_list`, in their original order. Repeated events are matched one to one"""
+    seen = collections.Counter((event["date"], event["status"]) for event in previous_status_list)
+    events = []
+    for event in status_list:
+        key = (event["date"], event["status"])
+        if seen[key] > 0:
+            seen[key] -= 1
+        else:
+            events.append(event)
+    return events
+
+
+def apply_delta(previous_result, delta):
+    """Rebuilds the full result of a lookup from the previous result and a delta returned by :func:`request_incremental`"""
+    packages = [dict(package, status_list=list(package["status_list"])) for package in previous_result.get("packages", [])]
+    by_id = {package["package_id"]: package for package in packages}
+    for package in delta["packages"]:
+        if package["package_id"] in by_id:
+            by_id[package["package_id"]]["status_list"].extend(package["status_list"])
+        else:
+            packages.append(dict(package, status_list=list(package["status_list"])))
+    return build_query_result(packages)
+
+
+def build_query_result(packages):
+    return {
+        "found_packages": len(packages) > 0,
+        "total_packages": len(packages),
+        "packages": packages
+    }
+
+
+def http_call(request_session, method, url, properties, deadline=None, **kwargs):
+    """Sends an HTTP request with the retry policy of the query (`properties['retry_policy']`).
+
+    Timeouts are raised as :class:`utils.Lake_Exceptions.HttpTimeoutException`, refused or reset connections and non 200 answers as :class:`utils.Lake_Exceptions.BlockException`. Both are retried until the policy gives up or the deadline expires.
+
+    When `properties['concurrency_controller']` is set, every attempt holds a slot of the :class:`utils.Lake_Throttle.AimdController`, which shrinks the concurrency towards the host on those errors and on slow replies.
+
+    :returns: requests.Response with status code 200
+    """
+    controller = properties.get('concurrency_controller')
+
+    def send(timeout):
+        try:
+            response = request_session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout as error:
+            raise Exceptions.HttpTimeoutException(f"{method} {url}: {error}")
+        except requests.exceptions.ConnectionError as error:
+            raise Exceptions.BlockException(f"{method} {url}: {error}")
+        if response.status_code != 200:
+            raise Exceptions.BlockException(f"{method} {url} answered with status {response.status_code}")
+        return response
+
+    def attempt(timeout):
+        if controller is None:
+            return send(timeout)
+        # The time spent waiting for a slot counts against the attempt timeout
+        with controller.slot(url, timeout) as remaining:
+            return send(remaining)
+
+    policy = properties.get('retry_policy') or DEFAULT_RETRY_POLICY
+    return policy.run(attempt, deadline, f"{method} {url}")
+
+
+def open_session(properties, deadline=None):
+    """Creates the cookie session of a lookup by loading the start page. The session has its own cookies but reuses the keep-alive connections of the previous lookups of the process.
+
+    :returns: requests.Session
+    """
+    request_session = Transport.new_session({'User-Agent': properties['user_agent']},
+                                            pool_maxsize=properties.get('connection_pool_size', Transport.DEFAULT_POOL_MAXSIZE))
+    with Metrics.span("start_page"):
+        http_call(request_session, "GET", str(properties['start_url']), properties, deadline)
+    return request_session
+
+
+def submit_form(request_session, input_data, captcha_text, properties, deadline=None):
+    """Posts the search form with a solved captcha.
+
+    :returns: tuple (accepted, parsed response html). `accepted` is False when the host rejected the submit (usually a wrong `verificador`)
+    """
+    request_payload = {
+        "nome_razao": input_data.get("name"),
+        "cpf_cnpj" : input_data.get("cpf"),
+        "cep" : input_data.get("cep"),
+        "verificador": captcha_text,
+        "action": "pesquisar"
+    }
+
+    # Merged with the session headers, which keep the User-Agent
+    headers = {
+        'Accept-Language': 'en-US,en;q=0.9,pt-BR,es',
+        'Content-Type': properties['content_type'],
+    }
+
+    with Metrics.span("form_submit"):
+        form_submit_response = http_call(request_session, "POST", properties['submit_url'], properties, deadline, data=request_payload, headers=headers)
+    response_html = lxml.html.fromstring(form_submit_response.content)
+
+    _count("submits")
+    if "Ver Detalhes" in form_submit_response.text:
+        _count("submits_accepted")
+        return True, response_html
+    _count("submits_rejected")
+    return False, response_html
+
+
+def parse_search_result(response_html):
+    """Extracts the packages listed in an accepted search result.
+
+    :returns: tuple (data_codes, package_ids), the `onclick` attribute and the package id of every result row
+    """
     data_codes = response_html.xpath('//tr/@onclick')
     package_ids = response_html.xpath('//tr/td[1]/text()')
-    i = 0
-    for code in data_codes:
-        temp = {}
-        k = 0
-        res = request_session.get(properties['tracking_data_url'] + code.split("'")[1])
-
-        if res.status_code == 200:
-            query_result['found_packages'] = True
-            temp.update({"delivery_date": "10/10/2016"})
-            temp.update({"package_id" : package_ids[i]})
-            temp.update({ "status_list" : []})
-
-            i = i + 1
-            tree = lxml.html.fromstring(res.text)
-            rows = tree.xpath('//tr/td/font/text()')
-            for row in rows:
-                data = row.strip()
-                if len(data) > 0:
-                    k = k + 1
-                    m = k % 3
-                    if m == 1:
-                        temp_dic = {}
-                        temp_dic.update({"date": data})
-                    if m == 0:
-                        temp_dic.update({"status": data})
-                        temp['status_list'].append(temp_dic)
-            query_result['packages'].append(temp)
+    return data_codes, package_ids
+
+
+def fetch_result_packages(request_session, properties, response_html, deadline=None):
+    """Fetches the details of every package listed in an accepted search result.
+
+    When `properties['result_cache']` is set, the package of a terminal state is cached without expiry under :func:`package_cache_key`, and its detail page is not fetched again by the next lookups
+    """
+    data_codes, package_ids = parse_search_result(response_html)
+    cache = properties.get('result_cache')
+    if cache is None:
+        return fetch_package_details(request_session, properties, data_codes, package_ids, deadline)
+
+    cached = [cache.get(package_cache_key(package_id)) for package_id in package_ids]
+    pending = [index for index, package in enumerate(cached) if package is None]
+    Metrics.increment("detail_fetches_skipped", len(package_ids) - len(pending))
+    fetched = fetch_package_details(request_session, properties, [data_codes[index] for index in pending],
+                                    [package_ids[index] for index in pending], deadline)
+    for package in fetched:
+        if is_terminal_package(package):
+            cache.put(package_cache_key(package["package_id"]), package, Cache.NO_EXPIRY)
+
+    # Packages whose detail page could not be fetched are missing from `fetched`, which keeps the order of `pending`
+    packages = []
+    fetched = collections.deque(fetched)
+    for package_id, package in zip(package_ids, cached):
+        if package is None and fetched and fetched[0]["package_id"] == package_id:
+            package = fetched.popleft()
+        if package is not None:
+            packages.append(package)
+    return packages
+
+
+def package_cache_key(package_id):
+    """Cache key of the history of a package"""
+    return ("package", package_id)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_xpath(expression):
+    """Compiles an XPath expression once. Text results are plain strings (`smart_strings=False`)"""
+    return lxml.etree.XPath(expression, smart_strings=False)
+
+
+def parse_detail_page(html_text):
+    """Extracts the status history of a `tracking_encomenda.php` page.
+
+    Every history row has three cells: date, time and status. The date and status of each row are read from its own cells by precompiled XPath expressions, so a row never borrows the date or status of its neighbour, even when a cell is empty or split by a `<br>`.
+
+    :returns: list of {"date", "status"} dictionaries
+    """
+    tree = lxml.etree.HTML(html_text)
+    if tree is None:
+        return []
+    status_list = []
+    for row in compiled_xpath(DETAIL_ROWS_XPATH)(tree):
+        date = "".join(compiled_xpath(DETAIL_DATE_XPATH)(row)).strip()
+        status = "".join(compiled_xpath(DETAIL_STATUS_XPATH)(row)).strip()
+        if date or status:
+            status_list.append({"date": date, "status": status})
+    return status_list
+
+
+def fetch_package_details(request_session, properties, data_codes, package_ids, deadline=None):
+    """Fetches the detail page of every package concurrently over the keep-alive connections of the shared transport (see :mod:`utils.Lake_Transport`).
+
+    :param data_codes: The `onclick` attributes of the result table rows
+    :type data_codes: list
+    :param package_ids: The package ids of the result table rows, in the same order as `data_codes`
+    :type package_ids: list
+
+    :returns: list of package dictionaries following the order of `package_ids`. Packages whose detail page could not be fetched are left out, but an expired deadline is raised as :class:`utils.Lake_Exceptions.HttpTimeoutException`
+    """
+    fanout = max(1, min(properties.get('detail_fanout', DETAIL_FANOUT), len(data_codes)))
+
+    def fetch_package(index):
+        url = properties['tracking_data_url'] + data_codes[index].split("'")[1]
+        Metrics.increment("detail_fetches")
+        try:
+            with Metrics.span("detail_page"):
+                res = http_call(request_session, "GET", url, properties, deadline)
+        except Exceptions.BlockException as error:
+            print(error)
+            return None
+        return {
+            "delivery_date": "10/10/2016",
+            "package_id": package_ids[index],
+            "status_list": parse_detail_page(res.text)
+        }
+
+    with Metrics.span("detail_pages"):
+        if fanout == 1:
+            packages = [fetch_package(index) for index in range(len(data_codes))]
         else:
-            print("Response Code:", res.status_code)
-        
-    query_result['total_packages'] = i
-    print("Success")
-    return query_result
+            with concurrent.futures.ThreadPoolExecutor(max_workers=fanout, thread_name_prefix="detail") as executor:
+                packages = list(executor.map(fetch_package, range(len(data_codes))))
+    return [package for package in packages if package is not None]
+
+
+def preprocess_captcha(images, threshold=80, blur_size=3, dilate_size=0):
+    """Cleans captcha images before OCR: every black (0) pixel and every pixel lighter than `threshold` becomes white (255), the dark strokes are optionally thickened and a box blur is applied.
+
+    :param images: A single grayscale image (h, w) or a batch of grayscale images (n, h, w)
+    :type images: numpy.ndarray
+    :param threshold: Pixels lighter than this value are considered background
+    :type threshold: int
+    :param blur_size: Odd size of the box blur kernel. 1 disables the blur
+    :type blur_size: int
+    :param dilate_size: Odd size of the square kernel used to thicken the dark strokes. 0 disables it
+    :type dilate_size: int
+
+    :returns: a new array with the same shape as `images` containing the refined image(s)
+    """
+    images = np.array(images, dtype=np.uint8, copy=True)
+    images[(images == 0) | (images > threshold)] = 255
+    if images.ndim == 2:
+        return _filter_captcha(images, blur_size, dilate_size)
+    # The thresholding above covers the whole batch at once, the cv2 filters run image by image
+    for index in range(len(images)):
+        images[index] = _filter_captcha(images[index], blur_size, dilate_size)
+    return images
+
+
+def _filter_captcha(image, blur_size, dilate_size):
+    if dilate_size > 1:
+        image = cv2.erode(image, np.ones((dilate_size, dilate_size), dtype=np.uint8))
+    if blur_size > 1:
+        image = cv2.blur(image, (blur_size, blur_size))
+    return image
+
+
+def decode_captcha(content):
+    """Decodes the raw captcha bytes returned by the host straight from memory.
+
+    :param content: The body of the captcha response
+    :type content: bytes
+
+    :returns: grayscale image as a numpy.ndarray
+    """
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("The captcha response is not a valid image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def is_valid_captcha(text):
+    return bool(text) and len(text) == CAPTCHA_LENGTH and text.isdigit()
 
 
-def get_capcha_string(url, request_session):
+def vote_captcha(candidates):
+    """Combines the readings of several preprocessing variants with a per-character majority vote.
+
+    :param candidates: The OCR readings of the same captcha as (text, confidences) tuples, see :func:`tools.captcha.ocr_engines.OcrEngine.image_to_string_with_confidences`
+    :type candidates: list
+
+    :returns: tuple (text, confidence). The text is None when the vote is inconclusive (a position without a strict majority of all the readings, invalid ones included). The confidence is the lowest per-character confidence: the share of readings agreeing on the character times their mean OCR confidence
+    """
+    valid = [(text, confidences) for text, confidences in candidates if is_valid_captcha(text)]
+    if not valid:
+        return None, 0.0
+    result = ""
+    confidence = 1.0
+    for position in range(CAPTCHA_LENGTH):
+        character, votes = collections.Counter(text[position] for text, _ in valid).most_common(1)[0]
+        if votes * 2 <= len(candidates):
+            return None, 0.0
+        ocr_confidences = [confidences[position] for text, confidences in valid
+                           if text[position] == character and confidences]
+        ocr_confidence = sum(ocr_confidences) / len(ocr_confidences) if ocr_confidences else 1.0
+        confidence = min(confidence, ocr_confidence * votes / len(candidates))
+        result += character
+    return result, confidence
+
+
+def get_ocr_pool(workers):
+    global _ocr_pool
+    with _captcha_lock:
+        if _ocr_pool is None or _ocr_pool._max_workers != workers:
+            if _ocr_pool is not None:
+                # Reads already submitted finish on the old threads, which then exit
+                _ocr_pool.shutdown(wait=False)
+            _ocr_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+        return _ocr_pool
+
+
+def get_captcha_stats():
+    """Returns a copy of the captcha counters along with the submit success rate and the network round trips saved per successful query.
+
+    Round trips are saved by refetches avoided through the variant vote and by low-confidence solves dropped before the form POST.
+    """
+    with _captcha_lock:
+        stats = dict(captcha_stats)
+    stats["submit_success_rate"] = stats["submits_accepted"] / stats["submits"] if stats["submits"] else 0.0
+    saved = stats["refetches_avoided"] + stats["low_confidence_drops"]
+    stats["round_trips_saved_per_success"] = saved / stats["submits_accepted"] if stats["submits_accepted"] else 0.0
+    return stats
+
+
+def _count(counter, amount=1):
+    with _captcha_lock:
+        captcha_stats[counter] += amount
+    Metrics.increment(CAPTCHA_METRIC_EVENTS.get(counter, counter), amount)
+
+
+def solve_captcha(image, query_properties):
+    """Reads a captcha. The digit classifier is tried first. When no classifier model is available or its confidence is under `digit_min_confidence` or `min_captcha_confidence`, every preprocessing variant of `captcha_variants` is read by the OCR engine on a worker pool and the readings are combined by :func:`vote_captcha`.
+
+    :param image: Grayscale captcha as returned by :func:`decode_captcha`
+    :type image: numpy.ndarray
+    :param query_properties: The query properties
+    :type query_properties: dict
+
+    :returns: tuple (text, confidence). The text is None if the vote is inconclusive. The confidence of a classifier solve is the lowest per-digit margin of :func:`tools.captcha.digit_classifier.DigitTemplateClassifier.solve`, so the `min_captcha_confidence` gate of :func:`solve_captcha_content` applies to it as to an OCR vote
+    """
+    _count("solves")
+    classifier = DigitClassifier.load_classifier(query_properties.get('digit_model', DigitClassifier.DEFAULT_MODEL_PATH))
+    if classifier is not None:
+        text, confidence = classifier.solve(preprocess_captcha(image))
+        # A classifier solve the submit gate would drop goes to the OCR vote instead of forcing a new captcha
+        if confidence >= query_properties.get('digit_min_confidence', 0.2) and is_confident_solve(confidence, query_properties):
+            return text, confidence
+
+    ocr_backend = query_properties.get('ocr_backend', OcrEngines.AUTO_BACKEND)
+    def read_variant(variant):
+        engine = OcrEngines.get_ocr_engine(ocr_backend)
+        return engine.image_to_string_with_confidences(preprocess_captcha(image, **variant))
+
+    variants = query_properties.get('captcha_variants') or [{}]
+    if len(variants) == 1:
+        return vote_captcha([read_variant(variants[0])])
+    candidates = list(get_ocr_pool(query_properties.get('ocr_workers', len(variants))).map(read_variant, variants))
+    result, confidence = vote_captcha(candidates)
+    if result and not is_valid_captcha(candidates[0][0]) and is_confident_solve(confidence, query_properties):
+        # The default preprocessing alone would have forced a new captcha download, and the vote is submitted
+        _count("refetches_avoided")
+    return result, confidence
+
+
+def solve_captcha_content(content, query_properties):
+    """Decodes and solves raw captcha bytes. Solves whose confidence is under `min_captcha_confidence` are dropped, as they would most likely be rejected by the host after a full form POST.
+
+    This function only needs the captcha related properties (see :data:`CAPTCHA_PROPERTIES`) so it can run on a process pool.
+
+    :returns: the captcha text, None if the solve failed or was not confident enough
+    """
+    with Metrics.span("ocr"):
+        result, confidence = solve_captcha(decode_captcha(content), query_properties)
+    if result and not is_confident_solve(confidence, query_properties):
+        _count("low_confidence_drops")
+        return None
+    return result
+
+
+def is_confident_solve(confidence, query_properties):
+    """True when a solve of this confidence passes the `min_captcha_confidence` gate and gets submitted"""
+    return confidence >= query_properties.get('min_captcha_confidence', 0.0)
+
+
+def fetch_and_solve_captcha(url, request_session, query_properties, deadline=None):
+    """Downloads a captcha and solves it with :func:`solve_captcha_content`. Download failures are raised (see :func:`http_call`).
+
+    :returns: tuple (captcha text, raw captcha bytes). The text is None if the solve failed or was not confident enough
+    """
+    with Metrics.span("captcha_download"):
+        response = http_call(request_session, "GET", url, query_properties, deadline)
     try:
-        response = request_session.get(url)
-        origin_png = "catpchar.png"
-        refined_png = "refine_captchar.png"
-        with open(origin_png, 'wb') as f:
-            f.write(response.content)
-        time.sleep(0.5)
-        image = cv2.imread(origin_png)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        h, w = image.shape
-        for i in range(h):
-            for j in range(w):
-                if image[i, j] == 0:
-                    image[i, j] = 255
-                if image[i, j] > 80:
-                    image[i, j] = 255
-
-        image = cv2.blur(image, (3, 3))
-        cv2.imwrite(refined_png, image)
-        captchar_string = pytesseract.image_to_string(Image.open(refined_png))
-        return captchar_string
+        return solve_captcha_content(response.content, query_properties), response.content
     except Exception as e:
+        print(e)
+        return None, response.content
+
+
+def solve_new_captcha(request_session, query_properties, deadline=None):
+    """Downloads captchas until one is solved with a valid 5 digits answer.
+
+    :returns: tuple (captcha text, raw captcha bytes)
+    :raises utils.Lake_Exceptions.BlockException: when `max_captcha_attempts` captchas in a row could not be solved
+    :raises utils.Lake_Exceptions.HttpTimeoutException: when the deadline expires
+    """
+    max_attempts = query_properties.get('max_captcha_attempts', 20)
+    for attempt in range(max_attempts):
+        if deadline is not None:
+            deadline.check("captcha solving")
+        if attempt > 0:
+            _count("refetches")
+        result, captcha_content = fetch_and_solve_captcha(query_properties['captcha_url'], request_session, query_properties, deadline)
+        if is_valid_captcha(result):
+            return result, captcha_content
+    raise Exceptions.BlockException(f"Failed to solve the captcha after {max_attempts} attempts")
+
+
+def warm_up(query_properties=properties):
+    """Loads the heavy resources of the query ahead of the first lookup: OpenCV, lxml, the HTTP transport, the digit classifier and one OCR engine per worker thread. Meant for resident workers such as tools/worker_daemon.py. The captcha counters are not touched.
+
+    :raises: the error of the OCR backend when it is not available
+    """
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(root_dir, "catpchar.png"), "rb") as captcha_file:
+        image = decode_captcha(captcha_file.read())
+    with open(os.path.join(root_dir, "reponse.html"), "rb") as detail_file:
+        parse_detail_page(detail_file.read().decode("latin-1"))
+    Transport.get_transport(pool_maxsize=query_properties.get('connection_pool_size', Transport.DEFAULT_POOL_MAXSIZE))
+    DigitClassifier.load_classifier(query_properties.get('digit_model', DigitClassifier.DEFAULT_MODEL_PATH))
+
+    ocr_backend = query_properties.get('ocr_backend', OcrEngines.AUTO_BACKEND)
+    variants = query_properties.get('captcha_variants') or [{}]
+    workers = query_properties.get('ocr_workers', len(variants))
+    def read_variant(variant):
+        return OcrEngines.get_ocr_engine(ocr_backend).image_to_string(preprocess_captcha(image, **variant))
+    # One read per worker thread creates its thread-local engine
+    list(get_ocr_pool(workers).map(read_variant, (variants * workers)[:max(workers, len(variants))]))
+
+
+def get_capcha_string(url, request_session, query_properties=properties):
+    try:
+        return fetch_and_solve_captcha(url, request_session, query_properties)[0]
+    except (Exceptions.BlockException, Exceptions.HttpTimeoutException) as e:
         print(e)
         return None
 
+
+def save_captcha_sample(samples_dir, content, label):
+    """Stores a raw captcha whose solve was accepted by the host, as training data for :mod:`tools.captcha.digit_classifier`"""
+    os.makedirs(samples_dir, exist_ok=True)
+    with open(os.path.join(samples_dir, label + "_" + uuid.uuid4().hex + ".png"), 'wb') as sample_file:
+        sample_file.write(content)
+
 # @hydra_tester(__file__)
 def test_request(my_test_properties):    
     # You can extend the properties from you file metadata
@@ -242,3 +714,4 @@ def test_request(my_test_properties):
 
 if __name__=="__main__":
     test_request(properties)
+    Metrics.dump('my_metrics.json')
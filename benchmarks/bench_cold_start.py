@@ -0,0 +1,53 @@
+"""
+Cold start benchmark of PES014: time for a fresh interpreter to import the query and load its parameters.
+
+Every scenario runs in a new process, so nothing is cached in `sys.modules`. The `eager` scenario also imports the
+dependencies that PES014 and :mod:`utils.Lake_Utils` now load on first use, which is what every worker paid before.
+The time of an empty interpreter is subtracted.
+
+:Usage:
+    >>> python benchmarks/bench_cold_start.py --runs 20
+"""
+import os
+import sys
+import argparse
+import subprocess
+import statistics
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "import PES014": "import PES014",
+    "import PES014 (eager)": "import PES014, cv2, numpy, lxml.html, lxml.etree, requests",
+    "import Lake_Utils": "import utils.Lake_Utils",
+    "import Lake_Utils (eager)": "import utils.Lake_Utils, lxml.html.clean, selenium.webdriver, urllib.request",
+    "load_parameters": "import utils.Lake_Utils as Utils; Utils.load_parameters('PES014.py')",
+}
+
+
+def startup_time(code, runs):
+    """Median wall time in seconds of `python -c code` over `runs` runs"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="PES014 cold start benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    arguments = parser.parse_args(arguments)
+
+    baseline = startup_time("pass", arguments.runs)
+    results = {}
+    for name, code in SCENARIOS.items():
+        results[name] = startup_time(code, arguments.runs) - baseline
+        print(f"{name:<28} {results[name] * 1000:>8.1f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    main()
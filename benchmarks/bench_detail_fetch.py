@@ -0,0 +1,46 @@
+"""
+Benchmark of the package detail fetching of PES014 against a local stub server.
+
+The stub (:mod:`tools.totalexpress_stub`) answers every `tracking_encomenda.php` request with the bundled `reponse.html`
+after a fixed latency.
+Queries with 1, 10 and 100 packages are fetched sequentially (fan-out 1) and concurrently.
+
+:Usage:
+    >>> python benchmarks/bench_detail_fetch.py
+"""
+import os
+import sys
+import time
+
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import PES014
+import tools.totalexpress_stub as Stub
+
+
+def main(latency=0.02, package_counts=(1, 10, 100), fanouts=(1, 8, 32)):
+    server = Stub.start_stub_server(latency=latency)
+    properties = PES014.properties_for_host(server.base_url)
+
+    results = {}
+    for package_count in package_counts:
+        data_codes = ["javascript:abrir('%d')" % n for n in range(package_count)]
+        package_ids = [str(n) for n in range(package_count)]
+        for fanout in fanouts:
+            properties["detail_fanout"] = fanout
+            with requests.session() as session:
+                start = time.perf_counter()
+                packages = PES014.fetch_package_details(session, properties, data_codes, package_ids)
+                elapsed = time.perf_counter() - start
+            assert [p["package_id"] for p in packages] == package_ids
+            results[f"{package_count}_packages_fanout_{fanout}"] = elapsed
+            print(f"{package_count:>4} packages  fan-out {fanout:>3}  {elapsed * 1000:>9.1f} ms")
+    server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Throughput benchmark of the `tracking_encomenda.php` parser of PES014.
+
+Compares the original modulo-3 walk over `//tr/td/font/text()` with :func:`PES014.parse_detail_page` on the bundled
+`reponse.html` and on a synthetic long history built from its rows. Both parsers must produce the same output.
+
+The libxml2 parse of the page dominates both parsers, so their throughput is expected to stay about the same: this
+benchmark guards against a regression of the per-row parser, it does not measure a speedup.
+
+:Usage:
+    >>> python benchmarks/bench_detail_parse.py
+"""
+import os
+import re
+import sys
+import time
+
+import lxml.html
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import PES014
+
+DETAIL_PAGE_FILE = os.path.join(ROOT_DIR, "reponse.html")
+
+
+def legacy_parse_detail_page(html_text):
+    """The parser PES014 used before the per-row :func:`PES014.parse_detail_page`"""
+    status_list = []
+    k = 0
+    tree = lxml.html.fromstring(html_text)
+    rows = tree.xpath('//tr/td/font/text()')
+    for row in rows:
+        data = row.strip()
+        if len(data) > 0:
+            k = k + 1
+            m = k % 3
+            if m == 1:
+                temp_dic = {}
+                temp_dic.update({"date": data})
+            if m == 0:
+                temp_dic.update({"status": data})
+                status_list.append(temp_dic)
+    return status_list
+
+
+def long_history(page, rows):
+    """Repeats the history rows of `page` until it has `rows` of them"""
+    history = re.findall(r"<tr>\s*<td width=\"25%\"> <font.*?</tr>", page, re.S)
+    repeated = (history * (rows // len(history) + 1))[:rows]
+    end = page.index("</table>", page.index(history[-1]))
+    return page[:page.index(history[0])] + "".join(repeated) + page[end:]
+
+
+def pages_per_second(parser, page, min_time=0.2, rounds=5):
+    """Best rate out of `rounds` rounds of at least `min_time` seconds each"""
+    best = 0.0
+    for _ in range(rounds):
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            parser(page)
+            count += 1
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    with open(DETAIL_PAGE_FILE, "rb") as page_file:
+        page = page_file.read().decode("latin-1")
+
+    results = {}
+    for name, fixture in (("reponse.html", page), ("500 rows", long_history(page, 500)),
+                          ("5000 rows", long_history(page, 5000))):
+        assert PES014.parse_detail_page(fixture) == legacy_parse_detail_page(fixture)
+        legacy = pages_per_second(legacy_parse_detail_page, fixture)
+        current = pages_per_second(PES014.parse_detail_page, fixture)
+        results[name] = {"legacy": legacy, "per_row": current}
+        print(f"{name:<14} legacy {legacy:>10.1f} pages/sec   per row {current:>10.1f} pages/sec  ({current / legacy:.2f}x)")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Throughput comparison of the OCR backends in :mod:`tools.captcha.ocr_engines`.
+
+Every available backend reads the refined bundled `catpchar.png` repeatedly and the result is reported in captchas/sec.
+Backends whose dependencies are missing are reported as unavailable.
+
+:Usage:
+    >>> python benchmarks/bench_ocr_engines.py
+"""
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import PES014
+import tools.captcha.ocr_engines as OcrEngines
+
+CAPTCHA_FILE = os.path.join(ROOT_DIR, "catpchar.png")
+
+
+def captchas_per_second(engine, image, repeat):
+    engine.image_to_string(image)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        engine.image_to_string(image)
+    return repeat / (time.perf_counter() - start)
+
+
+def main(repeat=50):
+    with open(CAPTCHA_FILE, "rb") as captcha_file:
+        image = PES014.preprocess_captcha(PES014.decode_captcha(captcha_file.read()))
+
+    results = {}
+    for backend in OcrEngines.ENGINES:
+        try:
+            engine = OcrEngines.create_ocr_engine(backend)
+            results[backend] = captchas_per_second(engine, image, repeat)
+            engine.close()
+        except Exception as error:
+            print(f"{backend:<12} unavailable: {error}")
+            continue
+        print(f"{backend:<12} {results[backend]:>10.1f} captchas/sec")
+    return results
+
+
+if __name__ == "__main__":
+    main()
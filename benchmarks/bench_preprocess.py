@@ -0,0 +1,64 @@
+"""
+Micro-benchmark for the captcha preprocessing stage of PES014.
+
+Compares the original per-pixel loop against :func:`PES014.preprocess_captcha` using the
+bundled `catpchar.png`, both for a single captcha and for a batch of captchas.
+
+:Usage:
+    >>> python benchmarks/bench_preprocess.py
+"""
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import PES014
+
+CAPTCHA_FILE = os.path.join(ROOT_DIR, "catpchar.png")
+
+
+def legacy_preprocess(image):
+    """The per-pixel loop PES014 used before :func:`PES014.preprocess_captcha`"""
+    image = image.copy()
+    h, w = image.shape
+    for i in range(h):
+        for j in range(w):
+            if image[i, j] == 0:
+                image[i, j] = 255
+            if image[i, j] > 80:
+                image[i, j] = 255
+    return cv2.blur(image, (3, 3))
+
+
+def pixels_per_second(function, argument, pixels, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    elapsed = time.perf_counter() - start
+    return pixels * repeat / elapsed
+
+
+def main(batch_size=256):
+    image = cv2.cvtColor(cv2.imread(CAPTCHA_FILE), cv2.COLOR_BGR2GRAY)
+    batch = np.repeat(image[np.newaxis], batch_size, axis=0)
+
+    assert np.array_equal(legacy_preprocess(image), PES014.preprocess_captcha(image))
+    assert np.array_equal(PES014.preprocess_captcha(batch)[-1], PES014.preprocess_captcha(image))
+
+    results = {
+        "legacy_loop": pixels_per_second(legacy_preprocess, image, image.size, 20),
+        "vectorized_single": pixels_per_second(PES014.preprocess_captcha, image, image.size, 2000),
+        "vectorized_batch": pixels_per_second(PES014.preprocess_captcha, batch, batch.size, 20),
+    }
+    for name, rate in results.items():
+        print(f"{name:<20} {rate:>16,.0f} pixels/sec  ({rate / results['legacy_loop']:.1f}x)")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+End-to-end benchmark suite of the PES014 query and the Hydra utilities.
+
+Every benchmark runs against the bundled fixtures (`catpchar.png`, `reponse.html`, `result_example.json`) and no
+network access is needed. The search result page is generated by :mod:`tools.totalexpress_stub`, as the
+repository has no capture of it. Results are written as JSON so that runs of different commits can be compared.
+
+:Usage:
+    $ python benchmarks/run_benchmarks.py --output bench_output.json
+    $ python benchmarks/run_benchmarks.py --compare bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+CAPTCHA_FILE = os.path.join(ROOT_DIR, "catpchar.png")
+DETAIL_PAGE_FILE = os.path.join(ROOT_DIR, "reponse.html")
+RESULT_FILE = os.path.join(ROOT_DIR, "result_example.json")
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a benchmark. The decorated function receives nothing and returns the callable to be timed"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def measure(function, min_time=0.5, min_repeat=5):
+    """Calls `function` until `min_time` seconds and `min_repeat` calls are reached, after one warm up call"""
+    function()
+    timings = []
+    total = 0.0
+    while total < min_time or len(timings) < min_repeat:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        total += elapsed
+    timings.sort()
+    return {
+        "repeat": len(timings),
+        "mean_s": total / len(timings),
+        "median_s": timings[len(timings) // 2],
+        "min_s": timings[0],
+        "ops_per_sec": len(timings) / total,
+    }
+
+
+def _read(path, mode="rb"):
+    with open(path, mode) as fixture:
+        return fixture.read()
+
+
+@benchmark("captcha_decode")
+def bench_captcha_decode():
+    import PES014
+    content = _read(CAPTCHA_FILE)
+    return lambda: PES014.decode_captcha(content)
+
+
+@benchmark("captcha_preprocess")
+def bench_captcha_preprocess():
+    import PES014
+    image = PES014.decode_captcha(_read(CAPTCHA_FILE))
+    return lambda: PES014.preprocess_captcha(image)
+
+
+@benchmark("captcha_preprocess_batch_64")
+def bench_captcha_preprocess_batch():
+    import numpy as np
+    import PES014
+    batch = np.repeat(PES014.decode_captcha(_read(CAPTCHA_FILE))[np.newaxis], 64, axis=0)
+    return lambda: PES014.preprocess_captcha(batch)
+
+
+@benchmark("captcha_ocr")
+def bench_captcha_ocr():
+    import PES014
+    import tools.captcha.ocr_engines as OcrEngines
+    image = PES014.preprocess_captcha(PES014.decode_captcha(_read(CAPTCHA_FILE)))
+    engine = OcrEngines.get_ocr_engine()
+    engine.image_to_string(image)
+    return lambda: engine.image_to_string(image)
+
+
+@benchmark("search_result_parse")
+def bench_search_result_parse():
+    import lxml.html
+    import PES014
+    import tools.totalexpress_stub as Stub
+    page = Stub.search_result_page([("%03d" % n, "27690%06d" % n) for n in range(20)])
+    return lambda: PES014.parse_search_result(lxml.html.fromstring(page))
+
+
+@benchmark("detail_page_parse")
+def bench_detail_page_parse():
+    import PES014
+    page = _read(DETAIL_PAGE_FILE).decode("latin-1")
+    return lambda: PES014.parse_detail_page(page)
+
+
+@benchmark("dump_dict_to_str")
+def bench_dump_dict_to_str():
+    import copy
+    import utils.Lake_Utils as Utils
+    result = json.loads(_read(RESULT_FILE, "r"))
+    return lambda: Utils.dump_dict_to_str(copy.deepcopy(result))
+
+
+@benchmark("generate_filename")
+def bench_generate_filename():
+    import utils.Lake_Utils as Utils
+    return lambda: Utils.generate_filename(["Raony", "06908488462", "50950005"], extension="json",
+                                           status="SUCCESS", timestamp="2019-06-15--01:00:00")
+
+
+@benchmark("save_data")
+def bench_save_data():
+    import utils.Lake_Utils as Utils
+    import utils.Lake_Enum as Enums
+    result = json.loads(_read(RESULT_FILE, "r"))
+    output_dir = tempfile.mkdtemp(prefix="hydra_bench_")
+
+    def save():
+        # save_data writes relative to the working directory
+        current_dir = os.getcwd()
+        os.chdir(output_dir)
+        try:
+            Utils.save_data(Enums.SAVE_TARGETS['PARSER'], "PES014", "2019-06-15--01:00:00",
+                            Utils.generate_filename(["Raony", "06908488462"], extension="json", status="SUCCESS",
+                                                    timestamp="2019-06-15--01:00:00"),
+                            result)
+        finally:
+            os.chdir(current_dir)
+    return save
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, min_time=0.5):
+    """Runs the selected benchmarks (all by default). Benchmarks whose dependencies are missing are reported as skipped"""
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks": {},
+        "skipped": {},
+    }
+    for name, setup in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        try:
+            function = setup()
+            report["benchmarks"][name] = measure(function, min_time)
+        except Exception as error:
+            report["skipped"][name] = "%s: %s" % (type(error).__name__, error)
+    return report
+
+
+def compare(report, baseline):
+    """Prints the speedup of every benchmark against a previous report (> 1 is faster)"""
+    for name, result in report["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous:
+            print(f"{name:<30} {previous['median_s'] / result['median_s']:>8.2f}x")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="PES014 benchmark suite")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare against")
+    parser.add_argument("--min-time", type=float, default=0.5, help="minimum seconds spent in each benchmark")
+    arguments = parser.parse_args(arguments)
+
+    report = run(arguments.names, arguments.min_time)
+    for name, result in report["benchmarks"].items():
+        print(f"{name:<30} {result['ops_per_sec']:>14,.1f} ops/sec   median {result['median_s'] * 1000:>10.4f} ms")
+    for name, reason in report["skipped"].items():
+        print(f"{name:<30} skipped ({reason})")
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            compare(report, json.load(baseline_file))
+    return report
+
+
+if __name__ == "__main__":
+    main()
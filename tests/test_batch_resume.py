@@ -0,0 +1,91 @@
+"""
+Crash recovery of the batch CLI: a worker killed in the middle of a segment leaves a `.part` file, and the resume
+recovers every record flushed before the kill.
+
+:Usage:
+    $ python -m pytest tests/
+"""
+import os
+import sys
+import signal
+import tempfile
+import unittest
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import tools.batch.cli as Cli
+import tools.batch.ndjson_sink as NdjsonSink
+
+# Worker writing records like tools.batch.cli.run_shard, then waiting to be killed with its segment still open
+WORKER_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+import tools.batch.ndjson_sink as NdjsonSink
+sink = NdjsonSink.NdjsonSink(sys.argv[2], prefix="results-shard000", compression=sys.argv[3] or None,
+                             flush_records=100)
+for index in range(int(sys.argv[4])):
+    sink.write({"index": index, "error": "BlockException()" if index % 10 == 9 else None})
+print("written", flush=True)
+time.sleep(60)
+"""
+
+RECORDS = 3050
+FLUSHED = 3000
+
+
+class BatchResumeTest(unittest.TestCase):
+
+    def kill_worker_mid_segment(self, output_dir, compression):
+        worker = subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT, ROOT_DIR, output_dir, compression or "",
+                                   str(RECORDS)], stdout=subprocess.PIPE)
+        self.assertEqual(worker.stdout.readline().strip(), b"written")
+        worker.send_signal(signal.SIGKILL)
+        worker.wait()
+        worker.stdout.close()
+        unfinished = [name for name in os.listdir(output_dir) if name.endswith(".part")]
+        self.assertEqual(len(unfinished), 1)
+        return os.path.join(output_dir, unfinished[0])
+
+    def check_resume(self, compression):
+        with tempfile.TemporaryDirectory() as output_dir:
+            part_path = self.kill_worker_mid_segment(output_dir, compression)
+
+            done = Cli.load_checkpoint(output_dir)
+            self.assertEqual(done, {index for index in range(FLUSHED) if index % 10 != 9})
+            self.assertFalse(os.path.exists(part_path))
+
+            # The recovered records, failed ones included, are in a complete segment: a second resume agrees
+            names = os.listdir(output_dir)
+            self.assertEqual(len(names), 1)
+            recovered = list(NdjsonSink.read_segments([os.path.join(output_dir, names[0])]))
+            self.assertEqual([record["index"] for record in recovered], list(range(FLUSHED)))
+            self.assertEqual(Cli.load_checkpoint(output_dir), done)
+
+    def test_resume_uncompressed(self):
+        self.check_resume(None)
+
+    def test_resume_gzip(self):
+        self.check_resume("gzip")
+
+    def test_resume_bz2(self):
+        self.check_resume("bz2")
+
+    def test_truncated_part_is_kept(self):
+        for compression in (None, "gzip", "bz2"):
+            with tempfile.TemporaryDirectory() as output_dir:
+                part_path = self.kill_worker_mid_segment(output_dir, compression)
+                # A crash in the middle of a write cuts the last flushed chunk short
+                with open(part_path, "rb+") as part_file:
+                    part_file.truncate(os.path.getsize(part_path) - 20)
+
+                done = Cli.load_checkpoint(output_dir)
+                # Every chunk before the last one is recovered
+                self.assertTrue({index for index in range(FLUSHED - 100) if index % 10 != 9} <= done)
+                self.assertTrue(done <= {index for index in range(FLUSHED) if index % 10 != 9})
+                self.assertTrue(os.path.exists(part_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Asyncio batch engine for Hydra queries.
+
+Runs one query for many inputs concurrently under a concurrency cap and streams the results in completion order.
+Every lookup is a separate call to the query function, so each one keeps its own cookie session.
+
+:Example:
+    >>> import asyncio
+    >>> import PES014
+    >>> import tools.batch.async_batch as AsyncBatch
+    >>> async def main(inputs):
+    >>>     async for item in AsyncBatch.run_batch(PES014.request, inputs, PES014.properties, concurrency=20):
+    >>>         print(item.input_data, item.error or item.result)
+    >>> asyncio.run(main([{"name": "Raony", "cpf": "06908488462", "cep": "50950005"}]))
+"""
+import time
+import asyncio
+import collections
+import concurrent.futures
+
+BatchResult = collections.namedtuple("BatchResult", ["input_data", "result", "error", "elapsed"])
+
+
+def _timed_query(query, input_data, properties):
+    start = time.perf_counter()
+    try:
+        return BatchResult(input_data, query(input_data, properties), None, time.perf_counter() - start)
+    except Exception as error:
+        return BatchResult(input_data, None, error, time.perf_counter() - start)
+
+
+async def run_batch(query, inputs, properties, concurrency=10, executor=None):
+    """Runs `query` for every input with at most `concurrency` lookups in flight.
+
+    Inputs are pulled lazily from the iterable, so it can be a generator over a very large file.
+
+    :param query: The query function, called as `query(input_data, properties)`. It runs on a worker thread
+    :type query: function
+    :param inputs: iterable of input dictionaries
+    :type inputs: iterable
+    :param properties: The query properties shared by every lookup
+    :type properties: dict
+    :param concurrency: Maximum number of lookups running at the same time
+    :type concurrency: int
+    :param executor: (optional) The executor running the query calls. A thread pool of `concurrency` workers is created by default
+    :type executor: concurrent.futures.Executor
+
+    :returns: async generator of :class:`BatchResult` in completion order. Failed lookups carry the exception in `error`
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+
+    inputs = iter(inputs)
+    pending = set()
+    try:
+        while True:
+            for input_data in inputs:
+                pending.add(loop.run_in_executor(executor, _timed_query, query, input_data, properties))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+def run_batch_sync(query, inputs, properties, concurrency=10, callback=None):
+    """Blocking helper around :func:`run_batch` for scripts without an event loop.
+
+    :param callback: (optional) called with every :class:`BatchResult` as soon as it is available. The results are then not kept in memory
+    :type callback: function
+
+    :returns: list of :class:`BatchResult` in completion order, or the number of results handed to `callback` when one is given
+    """
+    async def collect():
+        results = []
+        count = 0
+        async for item in run_batch(query, inputs, properties, concurrency):
+            if callback is not None:
+                callback(item)
+                count += 1
+            else:
+                results.append(item)
+        return count if callback is not None else results
+    return asyncio.run(collect())
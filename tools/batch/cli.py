@@ -0,0 +1,199 @@
+"""
+Command line entry point for PES014 batch runs.
+
+Inputs are read from a CSV file with a header (`name,cpf,cep`) or from an NDJSON file with one input dictionary per
+line. The inputs are sharded by position over `--workers` processes, so the CPU-bound captcha OCR runs on every
+core, and each process runs `--concurrency` lookups at a time with :func:`tools.batch.async_batch.run_batch`.
+Results are written by every process to its own :class:`tools.batch.ndjson_sink.NdjsonSink` segments in `--output`.
+
+Every output record carries the position of its input, so the output directory is also the checkpoint of the run:
+running the same command again after a crash skips the inputs that already have a result. Inputs whose lookup failed
+are run again, their failed records stay in the output before the new one. Segments left unfinished by the crash
+(`.part` files) are recovered up to their last complete line.
+
+:Usage:
+    $ python -m tools.batch.cli inputs.csv --output results/ --workers 4 --concurrency 16 --compression gzip
+    $ python -m tools.batch.cli inputs.ndjson --output results/ --host http://127.0.0.1:8080
+"""
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import asyncio
+import argparse
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import tools.batch.ndjson_sink as NdjsonSink
+
+INPUT_FIELDS = ("name", "cpf", "cep")
+PROGRESS_INTERVAL = 1.0
+
+
+def read_inputs(path, input_format="auto"):
+    """Yields the input dictionaries of a CSV or NDJSON file, streaming it
+
+    :param input_format: "csv", "ndjson" or "auto" to pick it from the file extension
+    :type input_format: str
+    """
+    if input_format == "auto":
+        input_format = "csv" if path.lower().endswith(".csv") else "ndjson"
+    with open(path, "r", encoding="utf-8", newline="") as input_file:
+        if input_format == "csv":
+            for row in csv.DictReader(input_file):
+                yield {field: row.get(field) for field in INPUT_FIELDS}
+        else:
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _read_records(path):
+    """Yields the complete records of a segment, stopping at the first truncated or corrupted line"""
+    try:
+        for record in NdjsonSink.read_segments([path]):
+            yield record
+    except (EOFError, OSError, ValueError):
+        return
+
+
+def load_checkpoint(output_dir, prefix="results"):
+    """Collects the input positions that already have a result in `output_dir` and recovers unfinished segments.
+    Records of failed lookups (`error` set) do not count, so those inputs are retried. An unfinished segment is only
+    removed once it was read to its end.
+
+    :returns: set of input positions
+    """
+    done = set()
+    if not os.path.isdir(output_dir):
+        return done
+    names = sorted(name for name in os.listdir(output_dir) if name.startswith(prefix) and ".ndjson" in name)
+    unfinished = [name for name in names if name.endswith(".part")]
+    for name in names:
+        if not name.endswith(".part"):
+            done.update(record["index"] for record in _read_records(os.path.join(output_dir, name))
+                        if record.get("error") is None)
+    if unfinished:
+        with NdjsonSink.NdjsonSink(output_dir, prefix=prefix + "-recovered") as sink:
+            for name in unfinished:
+                reader = NdjsonSink.UnfinishedSegmentReader(os.path.join(output_dir, name))
+                for record in reader:
+                    if record["index"] not in done:
+                        sink.write(record)
+                        if record.get("error") is None:
+                            done.add(record["index"])
+                if reader.complete:
+                    os.remove(reader.path)
+                else:
+                    print(f"{name} ends with a truncated or corrupted record, it is kept for inspection", flush=True)
+    return done
+
+
+def _query_item(item, properties):
+    import PES014
+    return PES014.request(item[1], properties)
+
+
+def run_shard(shard, shards, arguments, done, progress):
+    """Worker process: runs the lookups of the inputs whose position modulo `shards` is `shard`"""
+    import PES014
+    import tools.batch.async_batch as AsyncBatch
+
+    properties = PES014.properties_for_host(arguments.host) if arguments.host else dict(PES014.properties)
+    inputs = ((index, input_data) for index, input_data in enumerate(read_inputs(arguments.input, arguments.format))
+              if index % shards == shard and index not in done)
+    sink = NdjsonSink.NdjsonSink(arguments.output, prefix=f"{arguments.prefix}-shard{shard:03d}",
+                                 max_segment_records=arguments.segment_records, compression=arguments.compression,
+                                 flush_records=arguments.flush_records)
+
+    async def run():
+        async for item in AsyncBatch.run_batch(_query_item, inputs, properties, concurrency=arguments.concurrency):
+            sink.write({
+                "index": item.input_data[0],
+                "query_input": item.input_data[1],
+                "result": item.result,
+                "error": repr(item.error) if item.error is not None else None,
+                "elapsed": item.elapsed,
+            })
+            progress.put((shard, item.error is None))
+
+    try:
+        asyncio.run(run())
+    finally:
+        sink.close()
+
+
+def format_progress(finished, failed, total, elapsed):
+    rate = finished / elapsed if elapsed > 0 else 0.0
+    eta = (total - finished) / rate if rate > 0 else float("inf")
+    return f"{finished}/{total} done, {failed} failed, {rate:.2f} lookups/sec, ETA {eta:.0f}s"
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Runs PES014 for every input of a CSV or NDJSON file")
+    parser.add_argument("input", help="CSV with a name,cpf,cep header or NDJSON file of input dictionaries")
+    parser.add_argument("--format", choices=["auto", "csv", "ndjson"], default="auto")
+    parser.add_argument("--output", default="batch_output", help="Directory of the NDJSON result segments")
+    parser.add_argument("--prefix", default="results")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="Lookups in flight in each worker")
+    parser.add_argument("--compression", choices=["gzip", "bz2"], default=None)
+    parser.add_argument("--segment-records", type=int, default=10000)
+    parser.add_argument("--flush-records", type=int, default=100)
+    parser.add_argument("--host", default=None, help="Alternative host, e.g. the stub of tools/totalexpress_stub.py")
+    arguments = parser.parse_args(arguments)
+
+    done = load_checkpoint(arguments.output, arguments.prefix)
+    total = sum(1 for index, _ in enumerate(read_inputs(arguments.input, arguments.format)) if index not in done)
+    print(f"{total} inputs to run, {len(done)} already done", flush=True)
+    if total == 0:
+        return 0
+
+    progress = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_shard, args=(shard, arguments.workers, arguments, done, progress),
+                                       name=f"pes014-shard{shard}") for shard in range(arguments.workers)]
+    for worker in workers:
+        worker.start()
+
+    start = time.perf_counter()
+    finished = failed = 0
+    last_report = start
+    try:
+        while finished < total and any(worker.is_alive() for worker in workers):
+            try:
+                shard, success = progress.get(timeout=PROGRESS_INTERVAL)
+                finished += 1
+                failed += 0 if success else 1
+            except queue.Empty:
+                pass
+            if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.perf_counter()
+                print(format_progress(finished, failed, total, last_report - start), flush=True)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume", flush=True)
+
+    # Workers only exit once their queued progress has been read
+    while any(worker.is_alive() for worker in workers) or not progress.empty():
+        try:
+            shard, success = progress.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        finished += 1
+        failed += 0 if success else 1
+    for worker in workers:
+        worker.join()
+    print(format_progress(finished, failed, total, time.perf_counter() - start), flush=True)
+    crashed = [worker.name for worker in workers if worker.exitcode != 0]
+    if crashed:
+        print(f"Workers exited with errors: {', '.join(crashed)}. Run the same command again to resume", flush=True)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
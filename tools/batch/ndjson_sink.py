@@ -0,0 +1,233 @@
+"""
+Streaming NDJSON sink for batch runs.
+
+Every result is appended as one JSON line to the current segment file. A segment is rotated when it reaches
+`max_segment_bytes` (uncompressed) or `max_segment_records`, and can be compressed with gzip or bz2. Lines are
+buffered and written out every `flush_records` lines or `flush_bytes` bytes, so the memory used by the sink does not
+grow with the size of the batch. A compressed segment holds one complete gzip or bz2 stream per write, which
+`gzip.open` and `bz2.open` read as a single file, so everything written before a crash can be decompressed.
+
+A segment is written as `<name>.part` and renamed when it is closed, so readers only ever see complete segments.
+
+:Example:
+    >>> import PES014
+    >>> import tools.batch.async_batch as AsyncBatch
+    >>> import tools.batch.ndjson_sink as NdjsonSink
+    >>> with NdjsonSink.NdjsonSink("results/", compression="gzip") as sink:
+    >>>     AsyncBatch.run_batch_sync(PES014.request, inputs, PES014.properties, callback=sink.write_batch_result)
+    >>> print(sink.segments)
+"""
+import os
+import bz2
+import gzip
+import json
+import time
+import zlib
+import threading
+
+# Compression of a written chunk and extension of the segments
+COMPRESSORS = {
+    None: (None, ""),
+    "gzip": (gzip.compress, ".gz"),
+    "bz2": (bz2.compress, ".bz2"),
+}
+
+
+class NdjsonSink():
+    """Appends records to rotating NDJSON segment files.
+
+    :param directory: Directory of the segments, created if missing
+    :type directory: str
+    :param prefix: Prefix of the segment file names
+    :type prefix: str
+    :param max_segment_bytes: Uncompressed size after which the segment is rotated
+    :type max_segment_bytes: int
+    :param max_segment_records: (optional) Number of records after which the segment is rotated
+    :type max_segment_records: int
+    :param compression: None, "gzip" or "bz2"
+    :type compression: str
+    :param flush_records: Number of buffered lines that triggers a write to the segment
+    :type flush_records: int
+    :param flush_bytes: Size of the buffered lines that triggers a write to the segment
+    :type flush_bytes: int
+    """
+    def __init__(self, directory, prefix="results", max_segment_bytes=64 * 1024 * 1024, max_segment_records=None,
+                 compression=None, flush_records=1000, flush_bytes=1024 * 1024):
+        if compression not in COMPRESSORS:
+            raise ValueError(f"Unknown compression {compression!r}, use one of {list(COMPRESSORS)}")
+        self.directory = directory
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_records = max_segment_records
+        self.compression = compression
+        self.flush_records = flush_records
+        self.flush_bytes = flush_bytes
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.segment_file = None
+        self.segment_path = None
+        self.segment_bytes = 0
+        self.segment_records = 0
+        self.sequence = 0
+        self.records = 0
+        self.segments = []
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        extension = COMPRESSORS[self.compression][1]
+        name = f"{self.prefix}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.sequence:05d}.ndjson{extension}"
+        self.sequence += 1
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment_file = open(self.segment_path + ".part", "wb")
+        self.segment_bytes = 0
+        self.segment_records = 0
+
+    def _close_segment(self):
+        if self.segment_file is None:
+            return
+        self.segment_file.close()
+        os.replace(self.segment_path + ".part", self.segment_path)
+        self.segments.append(self.segment_path)
+        self.segment_file = None
+
+    def _flush_buffer(self):
+        if not self.buffer:
+            return
+        if self.segment_file is None:
+            self._open_segment()
+        compress = COMPRESSORS[self.compression][0]
+        chunk = b"".join(self.buffer)
+        # A stream per chunk: the compressor keeps no state between writes, so the file on disk is always readable
+        self.segment_file.write(compress(chunk) if compress is not None else chunk)
+        self.segment_file.flush()
+        self.segment_bytes += self.buffer_bytes
+        self.segment_records += len(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+        if self.segment_bytes >= self.max_segment_bytes or \
+                (self.max_segment_records is not None and self.segment_records >= self.max_segment_records):
+            self._close_segment()
+
+    def write(self, record):
+        """Appends a JSON serializable record. Values JSON does not know, like datetimes, are written as strings"""
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        with self.lock:
+            self.buffer.append(line)
+            self.buffer_bytes += len(line)
+            self.records += 1
+            # A segment never exceeds its record limit, even when it is lower than flush_records
+            segment_full = self.max_segment_records is not None and \
+                self.segment_records + len(self.buffer) >= self.max_segment_records
+            if segment_full or len(self.buffer) >= self.flush_records or self.buffer_bytes >= self.flush_bytes \
+                    or self.segment_bytes + self.buffer_bytes >= self.max_segment_bytes:
+                self._flush_buffer()
+
+    def write_batch_result(self, item):
+        """Appends a :class:`tools.batch.async_batch.BatchResult`, suitable as the `callback` of :func:`tools.batch.async_batch.run_batch_sync`"""
+        self.write({
+            "query_input": item.input_data,
+            "result": item.result,
+            "error": repr(item.error) if item.error is not None else None,
+            "elapsed": item.elapsed,
+        })
+
+    def flush(self):
+        """Writes the buffered lines to the current segment"""
+        with self.lock:
+            self._flush_buffer()
+
+    def close(self):
+        """Writes the buffered lines and closes the current segment"""
+        with self.lock:
+            self._flush_buffer()
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_segments(paths):
+    """Yields the records of NDJSON segments, compressed or not, in the given order"""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else bz2.open if path.endswith(".bz2") else open
+        with opener(path, "rt", encoding="utf-8") as segment_file:
+            for line in segment_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class UnfinishedSegmentReader():
+    """Reads the records of a segment left unfinished by a crash (`.part` file), up to its last complete line.
+
+    The compressed streams are decompressed incrementally, so the lines of the streams written before the crash are
+    read even when the last one was cut short. After the iteration, `complete` tells whether the whole file was read:
+    a file ending with a truncated stream, a truncated line or a corrupted record still holds data and must be kept.
+
+    :param path: Path of the `.part` file
+    :type path: str
+    :param chunk_size: Number of bytes read from the file at a time
+    :type chunk_size: int
+
+    :Example:
+        >>> reader = NdjsonSink.UnfinishedSegmentReader("results/results-20200101000000-42-00003.ndjson.gz.part")
+        >>> records = list(reader)
+        >>> if reader.complete:
+        >>>     os.remove(reader.path)
+    """
+    def __init__(self, path, chunk_size=1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.complete = False
+        name = path[:-len(".part")] if path.endswith(".part") else path
+        self.compression = "gzip" if name.endswith(".gz") else "bz2" if name.endswith(".bz2") else None
+
+    def _new_decompressor(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(wbits=31)
+        if self.compression == "bz2":
+            return bz2.BZ2Decompressor()
+        return None
+
+    def _read_data(self):
+        """Yields the decompressed content of the file. Returns True when it does not end inside a stream"""
+        decompressor = self._new_decompressor()
+        in_stream = False
+        with open(self.path, "rb") as segment_file:
+            for data in iter(lambda: segment_file.read(self.chunk_size), b""):
+                if decompressor is None:
+                    yield data
+                    continue
+                while data:
+                    in_stream = True
+                    yield decompressor.decompress(data)
+                    if not decompressor.eof:
+                        break
+                    # The sink writes one stream per flush, the rest of the data starts the next one
+                    data = decompressor.unused_data
+                    decompressor = self._new_decompressor()
+                    in_stream = False
+        return not in_stream
+
+    def __iter__(self):
+        self.complete = False
+        pending = b""
+        data = self._read_data()
+        try:
+            while True:
+                try:
+                    chunk = next(data)
+                except StopIteration as end:
+                    stream_complete = end.value
+                    break
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, OSError, ValueError, zlib.error):
+            return
+        self.complete = stream_complete and not pending.strip()
@@ -0,0 +1,226 @@
+"""
+Staged producer/consumer pipeline for batches of PES014 lookups.
+
+A lookup goes through five stages connected by bounded asyncio queues:
+
+ - `session`: loads the start page to get the cookie session (network)
+ - `captcha`: downloads a captcha (network)
+ - `ocr`: decodes, preprocesses and solves the captcha on a process pool sized to the available cores (CPU)
+ - `submit`: posts the search form (network)
+ - `details`: fetches and parses the package detail pages (network)
+
+Network stages run on a thread pool driven by the event loop while the OCR stage runs on worker processes, so
+HTTP waits and the GIL-bound OCR overlap instead of being serialized inside each `request()`. Lookups whose
+captcha could not be solved, or was rejected by the host, go back to the `captcha` stage.
+
+:Example:
+    >>> import asyncio
+    >>> import PES014
+    >>> import tools.batch.pipeline as Pipeline
+    >>> async def main(inputs):
+    >>>     pipeline = Pipeline.QueryPipeline(PES014.properties)
+    >>>     async for item in pipeline.run(inputs):
+    >>>         print(item.input_data, item.result)
+    >>>     print(pipeline.stats())
+    >>> asyncio.run(main(my_inputs))
+"""
+import os
+import time
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+import PES014
+import utils.Lake_Retry as Retry
+import utils.Lake_Exceptions as Exceptions
+from tools.batch.async_batch import BatchResult
+
+STAGES = ["session", "captcha", "ocr", "submit", "details"]
+MAX_CAPTCHA_FAILURES = 20  # Used when the properties do not define max_captcha_attempts
+MAX_SUBMIT_REJECTIONS = 3
+
+
+class LookupJob():
+    def __init__(self, input_data, timeout):
+        self.input_data = input_data
+        self.deadline = Retry.Deadline(timeout)
+        self.started = time.perf_counter()
+        self.session = None
+        self.captcha_content = None
+        self.captcha_text = None
+        self.response_html = None
+        self.captcha_failures = 0
+        self.rejections = 0
+
+
+class StageStats():
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+        self.processed = 0
+        self.busy_time = 0.0
+
+    def as_dict(self, elapsed):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "processed": self.processed,
+            "throughput": self.processed / elapsed if elapsed > 0 else 0.0,
+            "busy_time": self.busy_time,
+        }
+
+
+class QueryPipeline():
+    """Runs PES014 lookups through the staged pipeline.
+
+    :param properties: The PES014 query properties
+    :type properties: dict
+    :param max_in_flight: Maximum number of lookups inside the pipeline. Every queue is bounded by this value
+    :type max_in_flight: int
+    :param network_workers: Number of concurrent workers of each network stage
+    :type network_workers: int
+    :param ocr_processes: Size of the OCR process pool. Defaults to the number of cores
+    :type ocr_processes: int
+
+    .. note:: The captcha counters of :func:`PES014.get_captcha_stats` are kept by each OCR process and are not aggregated here
+    """
+    def __init__(self, properties, max_in_flight=64, network_workers=16, ocr_processes=None):
+        self.properties = properties
+        self.max_in_flight = max_in_flight
+        self.network_workers = network_workers
+        self.ocr_processes = ocr_processes or os.cpu_count() or 1
+        self.ocr_properties = {key: properties[key] for key in PES014.CAPTCHA_PROPERTIES if key in properties}
+        # Variants are read one after the other inside each process, the parallelism comes from the process pool
+        self.ocr_properties["ocr_workers"] = 1
+        self.queues = {}
+        self.stage_stats = {}
+        self.started = None
+
+    def stats(self):
+        """Returns the queue depth, processed count, throughput (items/sec) and busy time of every stage"""
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {name: stage.as_dict(elapsed) for name, stage in self.stage_stats.items()}
+
+    async def run(self, inputs):
+        """Runs a lookup for every input.
+
+        :param inputs: iterable of input dictionaries, consumed lazily
+        :type inputs: iterable
+
+        :returns: async generator of :class:`tools.batch.async_batch.BatchResult` in completion order
+        """
+        loop = asyncio.get_running_loop()
+        self.started = time.perf_counter()
+        self.queues = {name: asyncio.Queue(self.max_in_flight) for name in STAGES}
+        self.stage_stats = {name: StageStats(name, self.queues[name]) for name in STAGES}
+        output = asyncio.Queue()
+        admission = asyncio.Semaphore(self.max_in_flight)
+        network_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.network_workers * 4,
+                                                                 thread_name_prefix="pipeline")
+        # The network threads are already running: forked OCR workers could inherit locks held by them
+        ocr_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.ocr_processes,
+                                                              mp_context=multiprocessing.get_context("forkserver"))
+
+        async def finish(job, result=None, error=None):
+            if job.session is not None:
+                job.session.close()
+            await output.put(BatchResult(job.input_data, result, error, time.perf_counter() - job.started))
+            admission.release()
+
+        async def session_stage(job):
+            job.session = await loop.run_in_executor(network_executor, PES014.open_session, self.properties, job.deadline)
+            await self.queues["captcha"].put(job)
+
+        async def captcha_stage(job):
+            job.deadline.check("captcha download")
+            response = await loop.run_in_executor(network_executor, PES014.http_call, job.session, "GET",
+                                                  self.properties['captcha_url'], self.properties, job.deadline)
+            job.captcha_content = response.content
+            await self.queues["ocr"].put(job)
+
+        async def ocr_stage(job):
+            try:
+                job.captcha_text = await loop.run_in_executor(ocr_executor, PES014.solve_captcha_content,
+                                                              job.captcha_content, self.ocr_properties)
+            except Exception:
+                job.captcha_text = None
+            if PES014.is_valid_captcha(job.captcha_text):
+                await self.queues["submit"].put(job)
+            else:
+                job.captcha_failures += 1
+                if job.captcha_failures >= self.properties.get('max_captcha_attempts', MAX_CAPTCHA_FAILURES):
+                    await finish(job, error=Exceptions.BlockException("Failed to solve the captcha"))
+                else:
+                    await self.queues["captcha"].put(job)
+
+        async def submit_stage(job):
+            accepted, job.response_html = await loop.run_in_executor(
+                network_executor, PES014.submit_form, job.session, job.input_data, job.captcha_text, self.properties,
+                job.deadline)
+            if accepted:
+                if self.properties.get('captcha_samples_dir'):
+                    PES014.save_captcha_sample(self.properties['captcha_samples_dir'], job.captcha_content, job.captcha_text)
+                await self.queues["details"].put(job)
+            else:
+                job.rejections += 1
+                if job.rejections >= MAX_SUBMIT_REJECTIONS:
+                    await finish(job, result=PES014.build_query_result([]))
+                else:
+                    await self.queues["captcha"].put(job)
+
+        async def details_stage(job):
+            packages = await loop.run_in_executor(network_executor, PES014.fetch_result_packages,
+                                                  job.session, self.properties, job.response_html, job.deadline)
+            await finish(job, result=PES014.build_query_result(packages))
+
+        async def worker(name, handler):
+            queue = self.queues[name]
+            stage = self.stage_stats[name]
+            while True:
+                job = await queue.get()
+                start = time.perf_counter()
+                try:
+                    await handler(job)
+                except Exception as error:
+                    await finish(job, error=error)
+                stage.processed += 1
+                stage.busy_time += time.perf_counter() - start
+                queue.task_done()
+
+        handlers = {"session": session_stage, "captcha": captcha_stage, "ocr": ocr_stage,
+                    "submit": submit_stage, "details": details_stage}
+        workers = []
+        for name in STAGES:
+            count = self.ocr_processes if name == "ocr" else self.network_workers
+            workers.extend(asyncio.ensure_future(worker(name, handlers[name])) for _ in range(count))
+
+        async def feed():
+            submitted = 0
+            for input_data in inputs:
+                await admission.acquire()
+                await self.queues["session"].put(LookupJob(input_data, self.properties.get('timeout')))
+                submitted += 1
+            return submitted
+
+        feeder = asyncio.ensure_future(feed())
+        finished = 0
+        try:
+            while True:
+                if feeder.done():
+                    if finished == feeder.result():
+                        return
+                    item = await output.get()
+                else:
+                    getter = asyncio.ensure_future(output.get())
+                    await asyncio.wait([getter, feeder], return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        continue
+                    item = getter.result()
+                finished += 1
+                yield item
+        finally:
+            feeder.cancel()
+            for task in workers:
+                task.cancel()
+            network_executor.shutdown(wait=False)
+            ocr_executor.shutdown(wait=False)
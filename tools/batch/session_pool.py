@@ -0,0 +1,147 @@
+"""
+Pool of warm PES014 sessions.
+
+Background threads keep `size` sessions ready. Each one already holds the start page cookie and a solved
+`verificador`, so a lookup taking one from the pool only pays the form POST and the detail fetches. Every entry
+is used once, because the host invalidates a captcha after one submit. Entries older than `max_age` seconds are
+discarded, as the host may have expired their cookie or captcha. When the pool is empty, the lookup opens its own
+session as it would without a pool.
+
+:Example:
+    >>> import PES014
+    >>> import tools.batch.session_pool as SessionPool
+    >>> pool = SessionPool.WarmSessionPool(PES014.properties, size=8)
+    >>> properties = dict(PES014.properties, session_pool=pool)
+    >>> result = PES014.request({"name": "Raony", "cpf": "06908488462", "cep": "50950005"}, properties)
+    >>> pool.close()
+"""
+import time
+import threading
+import collections
+
+import PES014
+import utils.Lake_Retry as Retry
+import utils.Lake_Exceptions as Exceptions
+
+WarmSession = collections.namedtuple("WarmSession", ["session", "captcha_text", "captcha_content", "created"])
+
+
+class WarmSessionPool():
+    """Keeps sessions with a solved captcha ready for the next lookups.
+
+    :param properties: The PES014 query properties
+    :type properties: dict
+    :param size: Number of warm sessions kept ready
+    :type size: int
+    :param max_age: Seconds after which a warm session is considered stale and discarded
+    :type max_age: float
+    :param refill_workers: Number of background threads preparing sessions
+    :type refill_workers: int
+    """
+    def __init__(self, properties, size=8, max_age=60.0, refill_workers=2):
+        self.properties = properties
+        self.size = size
+        self.max_age = max_age
+        self.ready = collections.deque()
+        self.building = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "build_failures": 0}
+        self.workers = [threading.Thread(target=self._refill, name="session-pool-%d" % n, daemon=True)
+                        for n in range(refill_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def build(self, deadline=None):
+        """Prepares a warm session right away.
+
+        :param deadline: (optional) Deadline of the build, a new one of the `timeout` of the query properties by default
+        :type deadline: utils.Lake_Retry.Deadline
+
+        :returns: a :class:`WarmSession` or None if no captcha could be solved
+        """
+        if deadline is None:
+            deadline = Retry.Deadline(self.properties.get('timeout'))
+        session = PES014.open_session(self.properties, deadline)
+        try:
+            captcha_text, captcha_content = PES014.solve_new_captcha(session, self.properties, deadline)
+        except (Exceptions.BlockException, Exceptions.HttpTimeoutException):
+            session.close()
+            return None
+        return WarmSession(session, captcha_text, captcha_content, time.monotonic())
+
+    def _is_stale(self, warm_session):
+        return time.monotonic() - warm_session.created > self.max_age
+
+    def _discard_stale(self):
+        while self.ready and self._is_stale(self.ready[0]):
+            self.ready.popleft().session.close()
+            self.stats["expired"] += 1
+
+    def _refill(self):
+        failures = 0
+        while True:
+            with self.condition:
+                while not self.closed and len(self.ready) + self.building >= self.size:
+                    # Wake up in time to replace the oldest entry when it expires
+                    timeout = self.max_age - (time.monotonic() - self.ready[0].created) if self.ready else None
+                    self.condition.wait(max(timeout, 0.01) if timeout is not None else None)
+                    self._discard_stale()
+                if self.closed:
+                    return
+                self.building += 1
+            try:
+                warm_session = self.build()
+            except Exception:
+                warm_session = None
+            with self.condition:
+                self.building -= 1
+                if warm_session is None:
+                    self.stats["build_failures"] += 1
+                elif self.closed:
+                    warm_session.session.close()
+                else:
+                    self.ready.append(warm_session)
+                    self.condition.notify_all()
+            if warm_session is None:
+                failures += 1
+                time.sleep(min(0.5 * 2 ** failures, 30))
+            else:
+                failures = 0
+
+    def acquire(self, timeout=0.0, deadline=None):
+        """Takes a warm session out of the pool.
+
+        :param timeout: Seconds to wait for a warm session when none is ready
+        :type timeout: float
+        :param deadline: (optional) Deadline of the lookup, the wait never goes past it
+        :type deadline: utils.Lake_Retry.Deadline
+
+        :returns: a :class:`WarmSession`, or None when none is ready in time and the lookup must open its own session
+        """
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self._discard_stale()
+                if self.ready:
+                    self.stats["hits"] += 1
+                    warm_session = self.ready.popleft()
+                    self.condition.notify_all()
+                    return warm_session
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.closed:
+                    break
+                self.condition.wait(remaining)
+            self.stats["misses"] += 1
+        return None
+
+    def close(self):
+        """Stops the refill threads and closes every warm session"""
+        with self.condition:
+            self.closed = True
+            while self.ready:
+                self.ready.popleft().session.close()
+            self.condition.notify_all()
@@ -0,0 +1,321 @@
+"""
+Durable work queue of PES014 lookups, stored in a SQLite file.
+
+Any number of workers, on one machine or on several machines sharing a volume, can process the same queue file:
+
+ - a worker claims a batch of jobs, which leases them to it for `lease_seconds`
+ - while a job runs, the worker renews its leases with heartbeats
+ - a result is only committed by the worker still holding the lease, so a job is never committed twice
+ - a failed job goes back to the queue after an exponential backoff, and to the dead letters after `max_attempts`
+ - jobs leased by a worker that crashed are claimed again once their lease expires
+
+Every claim, heartbeat and commit is a short `BEGIN IMMEDIATE` transaction, so the SQLite file lock serializes the
+workers. Use the default rollback journal, not WAL, when the file lives on a network volume.
+
+:Usage:
+    $ python -m tools.batch.work_queue enqueue queue.db inputs.csv
+    $ python -m tools.batch.work_queue work queue.db --batch-size 16 --concurrency 8
+    $ python -m tools.batch.work_queue stats queue.db
+    $ python -m tools.batch.work_queue export queue.db results.ndjson
+
+:Example:
+    >>> import tools.batch.work_queue as WorkQueue
+    >>> queue = WorkQueue.WorkQueue("queue.db")
+    >>> queue.enqueue([{"name": "Raony", "cpf": "06908488462", "cep": "50950005"}])
+    >>> for job in queue.claim("worker-1", batch_size=10):
+    >>>     queue.complete("worker-1", job.id, PES014.request(job.input_data, PES014.properties))
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+import collections
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+Job = collections.namedtuple("Job", ["id", "input_data", "attempts"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, available_at);
+"""
+
+
+class WorkQueue():
+    """SQLite backed queue with leases, retries and dead letters.
+
+    :param path: Path of the queue file, created if missing
+    :type path: str
+    :param lease_seconds: Time a claimed job stays reserved to its worker without a heartbeat
+    :type lease_seconds: float
+    :param max_attempts: Number of attempts after which a job goes to the dead letters
+    :type max_attempts: int
+    :param retry_delay: Backoff before the second attempt of a failed job, doubled after every failure
+    :type retry_delay: float
+    """
+    def __init__(self, path, lease_seconds=60.0, max_attempts=3, retry_delay=30.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+
+    def _transaction(self, operation):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                value = operation(self.connection)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return value
+
+    def enqueue(self, inputs):
+        """Adds a job for every input dictionary
+
+        :returns: number of jobs added
+        """
+        rows = [(json.dumps(input_data, ensure_ascii=False), time.time()) for input_data in inputs]
+        self._transaction(lambda connection: connection.executemany(
+            "INSERT INTO jobs (input, updated) VALUES (?, ?)", rows))
+        return len(rows)
+
+    def claim(self, worker_id, batch_size=1):
+        """Leases up to `batch_size` available jobs to `worker_id`. Jobs whose lease expired are claimable again, or dead if they used all their attempts
+
+        :returns: list of :class:`Job`
+        """
+        def operation(connection):
+            now = time.time()
+            connection.execute(
+                "UPDATE jobs SET state = ?, error = 'lease expired', lease_owner = NULL, updated = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (DEAD, now, LEASED, now, self.max_attempts))
+            rows = connection.execute(
+                "SELECT id, input, attempts FROM jobs WHERE (state = ? AND available_at <= ?) "
+                "OR (state = ? AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (PENDING, now, LEASED, now, batch_size)).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated = ? "
+                "WHERE id = ?", [(LEASED, worker_id, now + self.lease_seconds, now, row[0]) for row in rows])
+            return [Job(job_id, json.loads(input_text), attempts + 1) for job_id, input_text, attempts in rows]
+        return self._transaction(operation)
+
+    def heartbeat(self, worker_id, job_ids):
+        """Renews the leases of `worker_id` on `job_ids`
+
+        :returns: set of the job ids still leased to `worker_id`
+        """
+        def operation(connection):
+            now = time.time()
+            owned = set()
+            for job_id in job_ids:
+                cursor = connection.execute(
+                    "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND state = ? AND lease_owner = ?",
+                    (now + self.lease_seconds, now, job_id, LEASED, worker_id))
+                if cursor.rowcount:
+                    owned.add(job_id)
+            return owned
+        return self._transaction(operation)
+
+    def complete(self, worker_id, job_id, result):
+        """Commits the result of a job
+
+        :returns: False when the lease was lost, the result is then discarded as another worker owns the job
+        """
+        def operation(connection):
+            return connection.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = NULL, lease_owner = NULL, updated = ? "
+                "WHERE id = ? AND state = ? AND lease_owner = ?",
+                (DONE, json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id, LEASED,
+                 worker_id)).rowcount == 1
+        return self._transaction(operation)
+
+    def fail(self, worker_id, job_id, error):
+        """Records a failed attempt. The job is retried after a backoff, or goes to the dead letters after `max_attempts`
+
+        :returns: False when the lease was lost
+        """
+        def operation(connection):
+            row = connection.execute("SELECT attempts FROM jobs WHERE id = ? AND state = ? AND lease_owner = ?",
+                                     (job_id, LEASED, worker_id)).fetchone()
+            if row is None:
+                return False
+            now = time.time()
+            state = DEAD if row[0] >= self.max_attempts else PENDING
+            connection.execute(
+                "UPDATE jobs SET state = ?, error = ?, available_at = ?, lease_owner = NULL, updated = ? WHERE id = ?",
+                (state, str(error), now + self.retry_delay * 2 ** (row[0] - 1), now, job_id))
+            return True
+        return self._transaction(operation)
+
+    def requeue_dead(self):
+        """Gives the dead letters a new set of attempts
+
+        :returns: number of jobs requeued
+        """
+        return self._transaction(lambda connection: connection.execute(
+            "UPDATE jobs SET state = ?, attempts = 0, available_at = 0, updated = ? WHERE state = ?",
+            (PENDING, time.time(), DEAD)).rowcount)
+
+    def next_claim_delay(self):
+        """Returns the seconds until a job can be claimed: the end of the earliest retry backoff or lease, 0.0 if one can be claimed now, None when no job is pending or leased"""
+        with self.lock:
+            available_at, lease_expires = self.connection.execute(
+                "SELECT (SELECT MIN(available_at) FROM jobs WHERE state = ?), "
+                "(SELECT MIN(lease_expires) FROM jobs WHERE state = ?)", (PENDING, LEASED)).fetchone()
+        moments = [moment for moment in (available_at, lease_expires) if moment is not None]
+        if not moments:
+            return None
+        return max(min(moments) - time.time(), 0.0)
+
+    def stats(self):
+        """Returns the number of jobs in every state"""
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        stats = {PENDING: 0, LEASED: 0, DONE: 0, DEAD: 0}
+        stats.update(dict(rows))
+        return stats
+
+    def results(self, state=DONE):
+        """Yields (input_data, result, error) of the jobs in `state`"""
+        with self.lock:
+            rows = self.connection.execute("SELECT input, result, error FROM jobs WHERE state = ? ORDER BY id",
+                                           (state,)).fetchall()
+        for input_text, result_text, error in rows:
+            yield json.loads(input_text), json.loads(result_text) if result_text else None, error
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def run_worker(work_queue, properties, worker_id=None, batch_size=16, concurrency=8, idle_exit=True, poll_interval=5.0):
+    """Claims and runs batches of jobs with :func:`PES014.request` until the queue is empty.
+
+    A heartbeat thread renews the leases of the running batch every third of the lease time.
+
+    :param idle_exit: Return once no job is pending or leased. Until then, wait for the end of the earliest retry backoff or lease and claim again. Otherwise keep polling the queue at least every `poll_interval` seconds
+    :type idle_exit: bool
+
+    :returns: dictionary with the number of jobs completed, failed and lost (lease taken over by another worker)
+    """
+    import PES014
+    import tools.batch.async_batch as AsyncBatch
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    counts = {"completed": 0, "failed": 0, "lost": 0}
+    while True:
+        jobs = work_queue.claim(worker_id, batch_size)
+        if not jobs:
+            # Failed jobs waiting out their backoff and jobs leased by other workers may still come back
+            wait = work_queue.next_claim_delay()
+            if wait is None:
+                if idle_exit:
+                    return counts
+                wait = poll_interval
+            elif not idle_exit:
+                wait = min(wait, poll_interval)
+            time.sleep(max(wait, 0.05))
+            continue
+
+        running = {job.id for job in jobs}
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(work_queue.lease_seconds / 3):
+                running.intersection_update(work_queue.heartbeat(worker_id, set(running)))
+
+        heartbeat_thread = threading.Thread(target=heartbeat, name="work-queue-heartbeat", daemon=True)
+        heartbeat_thread.start()
+
+        def commit(item):
+            job = item.input_data
+            if item.error is None:
+                committed = work_queue.complete(worker_id, job.id, item.result)
+            else:
+                committed = work_queue.fail(worker_id, job.id, repr(item.error))
+            counts["lost" if not committed else "completed" if item.error is None else "failed"] += 1
+            running.discard(job.id)
+
+        try:
+            AsyncBatch.run_batch_sync(lambda job, query_properties: PES014.request(job.input_data, query_properties),
+                                      jobs, properties, concurrency=concurrency, callback=commit)
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Durable SQLite work queue of PES014 lookups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    enqueue = commands.add_parser("enqueue", help="Adds the inputs of a CSV or NDJSON file")
+    enqueue.add_argument("queue")
+    enqueue.add_argument("input")
+    work = commands.add_parser("work", help="Processes jobs until the queue is empty")
+    work.add_argument("queue")
+    work.add_argument("--batch-size", type=int, default=16)
+    work.add_argument("--concurrency", type=int, default=8)
+    work.add_argument("--lease", type=float, default=60.0)
+    work.add_argument("--max-attempts", type=int, default=3)
+    work.add_argument("--forever", action="store_true", help="Keep polling the queue when it is empty")
+    work.add_argument("--host", default=None, help="Alternative host, e.g. the stub of tools/totalexpress_stub.py")
+    stats = commands.add_parser("stats", help="Shows the number of jobs in every state")
+    stats.add_argument("queue")
+    requeue = commands.add_parser("requeue-dead", help="Gives the dead letters a new set of attempts")
+    requeue.add_argument("queue")
+    export = commands.add_parser("export", help="Writes the finished jobs as NDJSON")
+    export.add_argument("queue")
+    export.add_argument("output")
+    export.add_argument("--state", choices=[DONE, DEAD], default=DONE)
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "enqueue":
+        import tools.batch.cli as Cli
+        print(f"{WorkQueue(arguments.queue).enqueue(Cli.read_inputs(arguments.input))} jobs added")
+    elif arguments.command == "work":
+        import PES014
+        properties = PES014.properties_for_host(arguments.host) if arguments.host else dict(PES014.properties)
+        work_queue = WorkQueue(arguments.queue, lease_seconds=arguments.lease, max_attempts=arguments.max_attempts)
+        print(run_worker(work_queue, properties, batch_size=arguments.batch_size, concurrency=arguments.concurrency,
+                         idle_exit=not arguments.forever))
+    elif arguments.command == "stats":
+        print(WorkQueue(arguments.queue).stats())
+    elif arguments.command == "requeue-dead":
+        print(f"{WorkQueue(arguments.queue).requeue_dead()} jobs requeued")
+    elif arguments.command == "export":
+        with open(arguments.output, "w", encoding="utf-8") as output_file:
+            for input_data, result, error in WorkQueue(arguments.queue).results(arguments.state):
+                output_file.write(json.dumps({"query_input": input_data, "result": result, "error": error},
+                                             ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Segment-and-classify solver for fixed-length numeric captchas such as the 5 digits Total Express captcha (PES014).
+
+The refined captcha (see :func:`PES014.preprocess_captcha`) is split into one glyph per digit using the column
+projection of the dark pixels. Each glyph is resized to a fixed size and matched against a nearest-neighbour
+model of labelled glyphs stored in a compressed `.npz` file.
+
+The model is trained from captchas labelled by successful submits. PES014 stores them in
+`properties['captcha_samples_dir']` as `<label>_<id>.png`.
+
+:Usage:
+    $ python -m tools.captcha.digit_classifier train captcha_samples/
+    $ python -m tools.captcha.digit_classifier evaluate captcha_samples/
+
+:Example:
+    >>> import tools.captcha.digit_classifier as DigitClassifier
+    >>> classifier = DigitClassifier.load_classifier(DigitClassifier.DEFAULT_MODEL_PATH)
+    >>> text, confidence = classifier.solve(refined_captcha_image)
+"""
+import os
+import time
+import random
+import argparse
+
+import utils.Lake_Imports as Imports
+
+cv2 = Imports.lazy_import("cv2")
+np = Imports.lazy_import("numpy")
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "pes014_digits.npz")
+
+GLYPH_HEIGHT = 16
+GLYPH_WIDTH = 12
+INK_THRESHOLD = 220  # Refined pixels darker than this belong to a digit
+DIGITS = "0123456789"
+
+
+def _split_widest(segments):
+    index = max(range(len(segments)), key=lambda i: segments[i][1] - segments[i][0])
+    start, end = segments[index]
+    middle = (start + end) // 2
+    return segments[:index] + [(start, middle), (middle, end)] + segments[index + 1:]
+
+
+def _merge_closest(segments):
+    index = min(range(len(segments) - 1), key=lambda i: segments[i + 1][0] - segments[i][1])
+    merged = (segments[index][0], segments[index + 1][1])
+    return segments[:index] + [merged] + segments[index + 2:]
+
+
+def segment_digits(image, n_digits=5):
+    """Splits a refined captcha into `n_digits` normalized glyphs.
+
+    :param image: Refined grayscale captcha, dark digits over a white background
+    :type image: numpy.ndarray
+    :param n_digits: The number of digits in the captcha
+    :type n_digits: int
+
+    :returns: a float32 array (n_digits, GLYPH_HEIGHT * GLYPH_WIDTH) or None when the image has no ink
+    """
+    ink = image < INK_THRESHOLD
+    columns = np.flatnonzero(ink.any(axis=0))
+    if columns.size == 0:
+        return None
+
+    # Runs of consecutive inked columns are the candidate digits
+    breaks = np.flatnonzero(np.diff(columns) > 1)
+    starts = np.concatenate(([columns[0]], columns[breaks + 1]))
+    ends = np.concatenate((columns[breaks], [columns[-1]])) + 1
+    segments = list(zip(starts.tolist(), ends.tolist()))
+    while len(segments) > n_digits:
+        segments = _merge_closest(segments)
+    while len(segments) < n_digits:
+        segments = _split_widest(segments)
+
+    glyphs = np.empty((n_digits, GLYPH_HEIGHT * GLYPH_WIDTH), dtype=np.float32)
+    for index, (start, end) in enumerate(segments):
+        glyph_ink = ink[:, start:end]
+        rows = np.flatnonzero(glyph_ink.any(axis=1))
+        glyph = glyph_ink[rows[0]:rows[-1] + 1] if rows.size else glyph_ink
+        glyph = cv2.resize(glyph.astype(np.float32), (GLYPH_WIDTH, GLYPH_HEIGHT), interpolation=cv2.INTER_AREA)
+        glyphs[index] = glyph.ravel()
+    return glyphs
+
+
+class DigitTemplateClassifier():
+    """Nearest-neighbour classifier over normalized digit glyphs
+
+    :param features: Labelled glyphs (n, GLYPH_HEIGHT * GLYPH_WIDTH)
+    :type features: numpy.ndarray
+    :param labels: The digit (0-9) of every glyph in `features`
+    :type labels: numpy.ndarray
+    :param n_digits: The number of digits in the captcha
+    :type n_digits: int
+    """
+    def __init__(self, features, labels, n_digits=5):
+        self.features = np.asarray(features, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.uint8)
+        self.n_digits = n_digits
+        self.squared_norms = (self.features ** 2).sum(axis=1)
+        self.known_digits = np.unique(self.labels)
+
+    def classify(self, glyphs):
+        """Classifies normalized glyphs.
+
+        :param glyphs: Output of :func:`segment_digits`
+        :type glyphs: numpy.ndarray
+
+        :returns: tuple (digits, confidences). `confidences` holds one value in [0, 1] per digit: the relative margin between the distance to the best digit and to the runner-up digit
+        """
+        distances = (glyphs ** 2).sum(axis=1)[:, np.newaxis] - 2 * glyphs @ self.features.T + self.squared_norms
+        distances = np.sqrt(np.maximum(distances, 0))
+        per_digit = np.full((glyphs.shape[0], 10), np.inf, dtype=np.float32)
+        for digit in self.known_digits:
+            per_digit[:, digit] = distances[:, self.labels == digit].min(axis=1)
+        ranked = np.sort(per_digit, axis=1)
+        best = per_digit.argmin(axis=1)
+        if len(self.known_digits) < 2:
+            return best, np.zeros(glyphs.shape[0], dtype=np.float32)
+        confidences = (ranked[:, 1] - ranked[:, 0]) / np.maximum(ranked[:, 1], 1e-6)
+        return best, confidences
+
+    def solve(self, image):
+        """Solves a refined captcha image.
+
+        :param image: Refined grayscale captcha
+        :type image: numpy.ndarray
+
+        :returns: tuple (text, confidence). `confidence` is the lowest per-digit confidence, 0.0 if the image could not be segmented
+        """
+        text, confidences = self.solve_digits(image)
+        return text, (float(min(confidences)) if confidences else 0.0)
+
+    def solve_digits(self, image):
+        """Same as :func:`solve` but returns the confidence of every digit as a list"""
+        glyphs = segment_digits(image, self.n_digits)
+        if glyphs is None:
+            return "", []
+        digits, confidences = self.classify(glyphs)
+        return "".join(DIGITS[d] for d in digits), confidences.tolist()
+
+    def save(self, path):
+        """Saves the model as a compressed `.npz` file"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez_compressed(path, features=self.features.astype(np.float16), labels=self.labels, n_digits=self.n_digits)
+
+
+_loaded_classifiers = {}
+
+
+def load_classifier(path=DEFAULT_MODEL_PATH):
+    """Loads (once per process) a model saved by :func:`DigitTemplateClassifier.save`
+
+    :param path: path to the `.npz` model
+    :type path: str
+
+    :returns: a :class:`DigitTemplateClassifier` or None if the model does not exist
+    """
+    if path not in _loaded_classifiers:
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as model:
+            _loaded_classifiers[path] = DigitTemplateClassifier(model["features"], model["labels"], int(model["n_digits"]))
+    return _loaded_classifiers[path]
+
+
+def load_samples(samples_dir):
+    """Reads labelled raw captchas named `<label>_<id>.png` from a directory.
+
+    :returns: list of (raw png bytes, label)
+    """
+    samples = []
+    for file_name in sorted(os.listdir(samples_dir)):
+        label = file_name.split("_")[0]
+        if not label.isdigit():
+            continue
+        with open(os.path.join(samples_dir, file_name), "rb") as sample_file:
+            samples.append((sample_file.read(), label))
+    return samples
+
+
+def train(samples, n_digits=5):
+    """Builds a classifier from refined captchas and their labels.
+
+    :param samples: iterable of (refined image, label)
+    :type samples: iterable
+
+    :returns: a :class:`DigitTemplateClassifier`
+    """
+    features = []
+    labels = []
+    for image, label in samples:
+        if len(label) != n_digits:
+            continue
+        glyphs = segment_digits(image, n_digits)
+        if glyphs is None:
+            continue
+        features.append(glyphs)
+        labels.extend(int(d) for d in label)
+    if not features:
+        raise ValueError("No usable labelled captcha was provided")
+    return DigitTemplateClassifier(np.concatenate(features), labels, n_digits)
+
+
+def evaluate(classifier, samples, min_confidence=0.0):
+    """Computes an accuracy report of the classifier.
+
+    :param samples: iterable of (refined image, label)
+    :param min_confidence: solves under this confidence are counted as rejected (they would fall back to OCR)
+
+    :returns: dict with captcha accuracy, digit accuracy, rejection rate and the mean solve time in milliseconds
+    """
+    total = correct = digits_total = digits_correct = rejected = 0
+    elapsed = 0.0
+    for image, label in samples:
+        start = time.perf_counter()
+        text, confidence = classifier.solve(image)
+        elapsed += time.perf_counter() - start
+        total += 1
+        digits_total += len(label)
+        digits_correct += sum(a == b for a, b in zip(text, label))
+        if confidence < min_confidence:
+            rejected += 1
+        elif text == label:
+            correct += 1
+    accepted = total - rejected
+    return {
+        "samples": total,
+        "captcha_accuracy": correct / accepted if accepted else 0.0,
+        "digit_accuracy": digits_correct / digits_total if digits_total else 0.0,
+        "rejection_rate": rejected / total if total else 0.0,
+        "mean_solve_ms": 1000 * elapsed / total if total else 0.0,
+    }
+
+
+def _refined_samples(samples_dir):
+    import PES014
+    return [(PES014.preprocess_captcha(PES014.decode_captcha(content)), label)
+            for content, label in load_samples(samples_dir)]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the PES014 digit captcha classifier")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("samples_dir", help="directory with labelled captchas named <label>_<id>.png")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--holdout", type=float, default=0.2, help="fraction of the samples kept out of training for the report")
+    parser.add_argument("--min-confidence", type=float, default=0.0)
+    arguments = parser.parse_args(arguments)
+
+    samples = _refined_samples(arguments.samples_dir)
+    if arguments.command == "train":
+        random.Random(0).shuffle(samples)
+        split = int(len(samples) * (1 - arguments.holdout))
+        training, holdout = samples[:split], samples[split:]
+        classifier = train(training)
+        classifier.save(arguments.model)
+        print(f"Model saved to {arguments.model} ({len(classifier.labels)} glyphs)")
+        if holdout:
+            print("Holdout report:", evaluate(classifier, holdout, arguments.min_confidence))
+    else:
+        classifier = load_classifier(arguments.model)
+        if classifier is None:
+            parser.error("model not found: " + arguments.model)
+        print("Report:", evaluate(classifier, samples, arguments.min_confidence))
+
+
+if __name__ == "__main__":
+    main()
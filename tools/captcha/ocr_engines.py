@@ -0,0 +1,171 @@
+"""
+OCR backends used to read captcha images.
+
+Two engines are provided:
+
+ - :class:`TesserocrEngine`: binds to the tesseract C++ API through `tesserocr`. The language data is loaded once
+   when the engine is created and the same engine is reused for every captcha.
+ - :class:`PytesseractEngine`: the historical behaviour. Every call forks a `tesseract` process through `pytesseract`.
+
+Use :func:`get_ocr_engine` instead of instantiating the engines directly. It returns a long-lived engine per thread
+and falls back to pytesseract when tesserocr is not installed. tesserocr is an optional dependency, listed in
+`requirements-optional.txt`.
+
+:Example:
+    >>> import tools.captcha.ocr_engines as OcrEngines
+    >>> engine = OcrEngines.get_ocr_engine()
+    >>> captcha_text = engine.image_to_string(refined_captcha_image)
+"""
+import threading
+
+AUTO_BACKEND = "auto"
+TESSEROCR_BACKEND = "tesserocr"
+PYTESSERACT_BACKEND = "pytesseract"
+
+
+class OcrEngine():
+    """Base class of every OCR backend. Subclasses must implement :func:`image_to_string`
+
+    :param char_whitelist: (optional) Only these characters will be recognized by the engine
+    :type char_whitelist: str
+    """
+    name = None
+
+    def __init__(self, char_whitelist=None):
+        self.char_whitelist = char_whitelist
+
+    def image_to_string(self, image):
+        """Reads the text of a grayscale image
+
+        :param image: 8-bit grayscale image
+        :type image: numpy.ndarray
+
+        :returns: the recognized text
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def image_to_string_with_confidences(self, image):
+        """Reads the text of a grayscale image along with the confidence of every character
+
+        :param image: 8-bit grayscale image
+        :type image: numpy.ndarray
+
+        :returns: tuple (text, confidences). `confidences` holds one value in [0, 1] per character of `text`, or is None when the engine cannot tell
+        """
+        return self.image_to_string(image), None
+
+    def close(self):
+        """Releases the resources held by the engine"""
+        pass
+
+
+class TesserocrEngine(OcrEngine):
+    """Persistent in-process tesseract engine. The tesseract API is not thread safe, so every instance must be used by a single thread at a time (:func:`get_ocr_engine` takes care of it)"""
+    name = TESSEROCR_BACKEND
+
+    def __init__(self, char_whitelist=None, lang="eng"):
+        super().__init__(char_whitelist)
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+        if char_whitelist:
+            self.api.SetVariable("tessedit_char_whitelist", char_whitelist)
+
+    def image_to_string(self, image):
+        height, width = image.shape[:2]
+        self.api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        return self.api.GetUTF8Text().strip()
+
+    def image_to_string_with_confidences(self, image):
+        height, width = image.shape[:2]
+        self.api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        self.api.Recognize()
+        level = self.tesserocr.RIL.SYMBOL
+        text = ""
+        confidences = []
+        for symbol in self.tesserocr.iterate_level(self.api.GetIterator(), level):
+            character = (symbol.GetUTF8Text(level) or "").strip()
+            if character:
+                text += character
+                confidences.extend([symbol.Confidence(level) / 100.0] * len(character))
+        return text, confidences
+
+    def close(self):
+        self.api.End()
+
+
+class PytesseractEngine(OcrEngine):
+    """Fallback engine spawning one `tesseract` process per image through `pytesseract`"""
+    name = PYTESSERACT_BACKEND
+
+    def __init__(self, char_whitelist=None):
+        super().__init__(char_whitelist)
+        import pytesseract
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        self.pytesseract = pytesseract
+        self.Image = Image
+        self.config = "-c tessedit_char_whitelist=" + char_whitelist if char_whitelist else ""
+
+    def image_to_string(self, image):
+        return self.pytesseract.image_to_string(self.Image.fromarray(image), config=self.config).strip()
+
+    def image_to_string_with_confidences(self, image):
+        # tesseract only reports word level confidences through the command line, every character gets the confidence of its word
+        data = self.pytesseract.image_to_data(self.Image.fromarray(image), config=self.config,
+                                              output_type=self.pytesseract.Output.DICT)
+        text = ""
+        confidences = []
+        for word, confidence in zip(data["text"], data["conf"]):
+            word = str(word).strip()
+            if word and float(confidence) >= 0:
+                text += word
+                confidences.extend([float(confidence) / 100.0] * len(word))
+        return text, confidences
+
+
+ENGINES = {TESSEROCR_BACKEND: TesserocrEngine, PYTESSERACT_BACKEND: PytesseractEngine}
+
+_thread_engines = threading.local()
+
+
+def create_ocr_engine(backend=AUTO_BACKEND, char_whitelist=None):
+    """Creates a new OCR engine.
+
+    :param backend: `tesserocr`, `pytesseract` or `auto`. `auto` tries tesserocr first and falls back to pytesseract
+    :type backend: str
+    :param char_whitelist: (optional) Only these characters will be recognized by the engine
+    :type char_whitelist: str
+
+    :returns: an :class:`OcrEngine` instance
+    """
+    if backend != AUTO_BACKEND:
+        if backend not in ENGINES:
+            raise ValueError("Unknown OCR backend: " + str(backend))
+        return ENGINES[backend](char_whitelist=char_whitelist)
+    try:
+        return TesserocrEngine(char_whitelist=char_whitelist)
+    except (ImportError, RuntimeError):
+        return PytesseractEngine(char_whitelist=char_whitelist)
+
+
+def get_ocr_engine(backend=AUTO_BACKEND, char_whitelist=None):
+    """Returns the long-lived OCR engine of the calling thread, creating it on first use.
+
+    :param backend: `tesserocr`, `pytesseract` or `auto`
+    :type backend: str
+    :param char_whitelist: (optional) Only these characters will be recognized by the engine
+    :type char_whitelist: str
+
+    :returns: an :class:`OcrEngine` instance
+    """
+    engines = getattr(_thread_engines, "engines", None)
+    if engines is None:
+        engines = _thread_engines.engines = {}
+    key = (backend, char_whitelist)
+    if key not in engines:
+        engines[key] = create_ocr_engine(backend, char_whitelist)
+    return engines[key]
@@ -0,0 +1,189 @@
+"""
+Local stand-in for tracking.totalexpress.com.br, used to load test the PES014 query offline and reproducibly.
+
+The stub serves the four endpoints the query uses:
+
+ - `GET /tracking/0`: start page, sets the session cookie
+ - `GET /images/imagem_verifica.php`: captcha image, the bundled `catpchar.png` (answer `02794`)
+ - `POST /tracking/0`: search result listing `package_count` packages, or a `span.erro` page when the captcha is checked and wrong
+ - `GET /tracking_encomenda.php?code=...`: package detail page, the bundled `reponse.html`
+
+Latency, jitter and error rate are configurable. A random seed makes the injected errors reproducible.
+
+:Usage:
+    $ python -m tools.totalexpress_stub --port 8080 --latency 0.05 --error-rate 0.01 --packages 3
+    $ PES014_HOST=http://127.0.0.1:8080 python PES014.py
+
+:Example:
+    >>> import PES014
+    >>> import tools.totalexpress_stub as Stub
+    >>> server = Stub.start_stub_server(latency=0.02, package_count=10)
+    >>> properties = PES014.properties_for_host(server.base_url)
+    >>> result = PES014.request({"name": "Raony", "cpf": "06908488462", "cep": "50950005"}, properties)
+    >>> server.shutdown()
+"""
+import os
+import time
+import uuid
+import random
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAPTCHA_FILE = os.path.join(ROOT_DIR, "catpchar.png")
+CAPTCHA_ANSWER = "02794"
+DETAIL_PAGE_FILE = os.path.join(ROOT_DIR, "reponse.html")
+
+START_PAGE = b"""<html><head><title>:: Total Express :. Tracking</title></head><body>
+<form method="post" action="/tracking/0">
+<input name="nome_razao"><input name="cpf_cnpj"><input name="cep">
+<img src="/images/imagem_verifica.php"><input name="verificador">
+<input type="hidden" name="action" value="pesquisar">
+</form></body></html>"""
+
+ERROR_PAGE = b"""<html><head><title>:: Total Express :. Tracking</title></head><body>
+<span class="erro">Codigo verificador invalido</span>
+</body></html>"""
+
+
+def search_result_page(package_ids):
+    rows = "".join(
+        '<tr onclick="abrirDetalhes(\'%s\')"><td>%s</td>'
+        '<td>Ver Detalhes</td></tr>' % (code, package_id) for code, package_id in package_ids)
+    return ("<html><head><title>:: Total Express :. Tracking</title></head><body><table>"
+            + rows + "</table></body></html>").encode("latin-1")
+
+
+class StubState():
+    def __init__(self, latency, jitter, error_rate, package_count, check_captcha, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.package_count = package_count
+        self.check_captcha = check_captcha
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        with open(CAPTCHA_FILE, "rb") as captcha_file:
+            self.captcha = captcha_file.read()
+        with open(DETAIL_PAGE_FILE, "rb") as detail_file:
+            self.detail_page = detail_file.read()
+
+    def delay_and_fail(self):
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        return failed
+
+
+class TotalExpressHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def reply(self, body, content_type="text/html; charset=ISO-8859-1", status=200, cookie=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if cookie:
+            self.send_header("Set-Cookie", "PHPSESSID=%s; path=/" % cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        if state.delay_and_fail():
+            return self.reply(b"Internal Server Error", "text/plain", 500)
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/tracking/0":
+            self.reply(START_PAGE, cookie=uuid.uuid4().hex)
+        elif path == "/images/imagem_verifica.php":
+            self.reply(state.captcha, "image/png")
+        elif path == "/tracking_encomenda.php":
+            self.reply(state.detail_page)
+        else:
+            self.reply(b"Not Found", "text/plain", 404)
+
+    def do_POST(self):
+        state = self.server.state
+        length = int(self.headers.get("Content-Length") or 0)
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("latin-1"))
+        if state.delay_and_fail():
+            return self.reply(b"Internal Server Error", "text/plain", 500)
+        if urllib.parse.urlparse(self.path).path != "/tracking/0":
+            return self.reply(b"Not Found", "text/plain", 404)
+        if state.check_captcha and form.get("verificador", [""])[0] != CAPTCHA_ANSWER:
+            return self.reply(ERROR_PAGE)
+        cpf = form.get("cpf_cnpj", ["0"])[0]
+        package_ids = [("%s%03d" % (cpf, n), "27690%06d" % n) for n in range(state.package_count)]
+        self.reply(search_result_page(package_ids))
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    @property
+    def base_url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+
+def start_stub_server(host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, package_count=3,
+                      check_captcha=False, seed=0):
+    """Starts the stub on a background thread.
+
+    :param port: TCP port, 0 picks a free one (see `server.base_url`)
+    :type port: int
+    :param latency: Seconds added to every response
+    :type latency: float
+    :param jitter: Up to this many random seconds are added on top of `latency`
+    :type jitter: float
+    :param error_rate: Fraction of the requests answered with HTTP 500
+    :type error_rate: float
+    :param package_count: Number of packages listed by every search result
+    :type package_count: int
+    :param check_captcha: Reject searches whose `verificador` is not the answer of the served captcha
+    :type check_captcha: bool
+    :param seed: Seed of the latency jitter and error injection
+    :type seed: int
+
+    :returns: the running :class:`StubServer`. Call `shutdown()` to stop it
+    """
+    server = StubServer((host, port), TotalExpressHandler)
+    server.state = StubState(latency, jitter, error_rate, package_count, check_captcha, seed)
+    threading.Thread(target=server.serve_forever, name="totalexpress-stub", daemon=True).start()
+    return server
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for tracking.totalexpress.com.br")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--packages", type=int, default=3)
+    parser.add_argument("--check-captcha", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args(arguments)
+
+    server = start_stub_server(arguments.host, arguments.port, arguments.latency, arguments.jitter,
+                               arguments.error_rate, arguments.packages, arguments.check_captcha, arguments.seed)
+    print("Total Express stub listening on " + server.base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
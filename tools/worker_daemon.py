@@ -0,0 +1,303 @@
+"""
+Resident worker serving lookups of a Hydra query over HTTP.
+
+The query module is imported and warmed up once (see :func:`PES014.warm_up`), so a lookup only pays its network and
+OCR work instead of the interpreter start, the OpenCV import and the OCR initialization of a fresh process.
+
+Endpoints:
+
+ - `POST /query`: runs `request(input_data, properties)` with the JSON body as input and answers the JSON result.
+   Failures answer HTTP 500 with `{"error", "error_type"}`, and HTTP 503 while the worker drains
+ - `GET /health`: state of the worker (`serving` or `draining`), lookups in flight and served
+ - `GET /metrics`: the :mod:`utils.Lake_Metrics` registry in the Prometheus text format
+
+On SIGTERM or SIGINT the worker drains: new lookups are refused with HTTP 503, the running ones are given
+`--drain-timeout` seconds to finish, then the process exits. When a Python file of the repository that the worker
+loaded changes, the worker stops accepting connections, so the new ones wait in the listen backlog, lets the running
+lookups finish and re-executes itself, handing its listening socket over so that clients are never refused.
+
+:Usage:
+    $ python -m tools.worker_daemon --port 8765 --concurrency 8
+    $ curl -X POST localhost:8765/query -d '{"name": "Raony", "cpf": "06908488462", "cep": "50950005"}'
+
+:Example:
+    >>> import tools.worker_daemon as WorkerDaemon
+    >>> result = WorkerDaemon.call_worker("http://127.0.0.1:8765", {"name": "Raony", "cpf": "06908488462", "cep": "50950005"})
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import importlib
+import threading
+import http.server
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import utils.Lake_Metrics as Metrics
+
+# File descriptor of the listening socket handed over to the re-executed worker
+LISTEN_FD_VARIABLE = "HYDRA_WORKER_LISTEN_FD"
+
+
+class WorkerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def reply(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.worker.reload_requested:
+            # The next request of the client goes to the listen backlog, served by the re-executed worker
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        worker = self.server.worker
+        if self.path == "/health":
+            self.reply(200, worker.health())
+        elif self.path == "/metrics":
+            self.reply(200, Metrics.REGISTRY.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self.reply(404, {"error": "Not Found"})
+
+    def do_POST(self):
+        worker = self.server.worker
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path != "/query":
+            return self.reply(404, {"error": "Not Found"})
+        try:
+            input_data = json.loads(body.decode("utf-8"))
+        except ValueError as error:
+            return self.reply(400, {"error": f"Invalid JSON body: {error}"})
+        if not worker.enter():
+            return self.reply(503, {"error": "The worker is draining"})
+        try:
+            result = worker.module.request(input_data, worker.properties)
+        except Exception as error:
+            self.reply(500, {"error": str(error), "error_type": type(error).__name__})
+        else:
+            self.reply(200, result)
+        finally:
+            worker.leave()
+
+    def log_message(self, *args):
+        pass
+
+
+class WorkerServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class WorkerDaemon():
+    """Serves the lookups of a query module until it is stopped or its code changes.
+
+    :param module_name: Name of the query module, which must define `request(input_data, properties)` and `properties`
+    :type module_name: str
+    :param address: (host, port) to listen on
+    :type address: tuple
+    :param query_host: (optional) Alternative host of the query, passed to its `properties_for_host`
+    :type query_host: str
+    :param concurrency: Maximum number of lookups running at the same time, the next ones wait for a free slot
+    :type concurrency: int
+    :param drain_timeout: Seconds given to the running lookups to finish when draining
+    :type drain_timeout: float
+    :param reload_interval: Seconds between two checks of the code files, None disables the reload
+    :type reload_interval: float
+    """
+    def __init__(self, module_name="PES014", address=("127.0.0.1", 8765), query_host=None, concurrency=8,
+                 drain_timeout=30.0, reload_interval=2.0):
+        self.module_name = module_name
+        self.address = address
+        self.query_host = query_host
+        self.drain_timeout = drain_timeout
+        self.reload_interval = reload_interval
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.served = 0
+        self.draining = False
+        self.reload_requested = False
+        self.started = time.time()
+        self.server = None
+        self.module = None
+        self.properties = None
+        self.code_files = {}
+
+    def load(self):
+        """Imports and warms up the query module"""
+        start = time.perf_counter()
+        self.module = importlib.import_module(self.module_name)
+        if self.query_host:
+            self.properties = self.module.properties_for_host(self.query_host)
+        else:
+            self.properties = dict(self.module.properties)
+        if hasattr(self.module, "warm_up"):
+            try:
+                self.module.warm_up(self.properties)
+            except Exception as error:
+                print(f"Warm up failed, the lookups will load their resources on demand: {error!r}", flush=True)
+        self.code_files = self._code_files()
+        print(f"{self.module_name} loaded in {time.perf_counter() - start:.2f}s", flush=True)
+
+    def _code_files(self):
+        """Modification times of the repository files loaded by the process"""
+        files = {}
+        for module in list(sys.modules.values()):
+            path = getattr(module, "__file__", None)
+            if path and path.endswith(".py") and os.path.abspath(path).startswith(ROOT_DIR + os.sep):
+                try:
+                    files[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return files
+
+    def code_changed(self):
+        for path, mtime in self.code_files.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def enter(self):
+        """Takes a lookup slot. False when the worker is draining"""
+        with self.condition:
+            if self.draining:
+                return False
+            self.in_flight += 1
+        self.slots.acquire()
+        return True
+
+    def leave(self):
+        self.slots.release()
+        with self.condition:
+            self.in_flight -= 1
+            self.served += 1
+            self.condition.notify_all()
+
+    def health(self):
+        with self.condition:
+            status = "draining" if self.draining else "reloading" if self.reload_requested else "serving"
+            return {"status": status, "module": self.module_name,
+                    "in_flight": self.in_flight, "served": self.served, "uptime": time.time() - self.started}
+
+    def wait_idle(self):
+        """Waits for the running lookups, at most `drain_timeout` seconds
+
+        :returns: True if every lookup finished
+        """
+        deadline = time.monotonic() + self.drain_timeout
+        with self.condition:
+            while self.in_flight > 0 and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.in_flight == 0
+
+    def drain(self):
+        """Refuses new lookups and waits for the running ones, at most `drain_timeout` seconds
+
+        :returns: True if every lookup finished
+        """
+        with self.condition:
+            self.draining = True
+        return self.wait_idle()
+
+    def stop(self, reload=False):
+        """Stops serving, from any thread but the serving one.
+
+        A reload only stops accepting connections, :func:`serve` then waits for the running lookups before re-executing
+        the worker. Otherwise the worker drains first
+        """
+        if reload:
+            with self.condition:
+                self.reload_requested = True
+        elif not self.drain():
+            print("Drain timeout, stopping with lookups still running", flush=True)
+        self.server.shutdown()
+
+    def _watch(self):
+        while not self.draining:
+            time.sleep(self.reload_interval)
+            if not self.draining and self.code_changed():
+                print("Code change detected, reloading once the running lookups finish", flush=True)
+                self.stop(reload=True)
+                return
+
+    def _open_server(self):
+        listen_fd = os.environ.pop(LISTEN_FD_VARIABLE, None)
+        if listen_fd is None:
+            return WorkerServer(self.address, WorkerHandler)
+        server = WorkerServer(self.address, WorkerHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = socket.socket(fileno=int(listen_fd))
+        server.server_address = server.socket.getsockname()
+        return server
+
+    def serve(self):
+        """Loads the query and serves until stopped. Re-executes the process when the code changed"""
+        self.load()
+        self.server = self._open_server()
+        self.server.worker = self
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda *args: threading.Thread(target=self.stop, daemon=True).start())
+        if self.reload_interval:
+            threading.Thread(target=self._watch, name="code-watcher", daemon=True).start()
+
+        print("Serving %s on http://%s:%d" % ((self.module_name,) + self.server.server_address[:2]), flush=True)
+        self.server.serve_forever()
+
+        if self.reload_requested:
+            # New connections wait in the listen backlog meanwhile
+            if not self.wait_idle():
+                print("Drain timeout, reloading with lookups still running", flush=True)
+        if self.reload_requested and not self.draining:
+            listen_fd = self.server.socket.fileno()
+            os.set_inheritable(listen_fd, True)
+            os.environ[LISTEN_FD_VARIABLE] = str(listen_fd)
+            os.execv(sys.executable, [sys.executable, "-m", "tools.worker_daemon"] + sys.argv[1:])
+        self.server.server_close()
+
+
+def call_worker(base_url, input_data, timeout=60):
+    """Runs a lookup on a resident worker
+
+    :returns: the query result
+    :raises: urllib.error.HTTPError when the lookup failed or the worker is draining
+    """
+    worker_request = urllib.request.Request(base_url + "/query", data=json.dumps(input_data).encode("utf-8"),
+                                            headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(worker_request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Resident worker serving Hydra query lookups over HTTP")
+    parser.add_argument("--module", default="PES014", help="Query module to serve")
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--host", default=None, help="Alternative host of the query, e.g. the stub of tools/totalexpress_stub.py")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--reload-interval", type=float, default=2.0, help="0 disables the reload on code change")
+    arguments = parser.parse_args(arguments)
+
+    os.chdir(ROOT_DIR)
+    WorkerDaemon(arguments.module, (arguments.bind, arguments.port), arguments.host, arguments.concurrency,
+                 arguments.drain_timeout, arguments.reload_interval or None).serve()
+
+
+if __name__ == "__main__":
+    main()
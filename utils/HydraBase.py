@@ -6,6 +6,13 @@ from . import Lake_Utils as Utils
 from . import Lake_Exceptions as Exceptions
 from . import Lake_Enum as Enums
 
+def release_driver(properties, broken=False):
+    """Gives the webdriver leased by a query back to the pool of :func:`.Lake_Utils.get_webdriver_pool`. A `broken` driver, one whose query raised, is quit instead of reused"""
+    driver = properties.get('driver')
+    if isinstance(driver, Utils.LazyWebDriver):
+        driver.release(broken)
+
+
 def hydra_query(query):
     """
     This is the decorator responsible for orchestrating the correct execution of a hydra query.
@@ -34,7 +41,13 @@ def hydra_query(query):
             raise ValueError("You should provide properties as a dict")
         file_timestamp = time.strftime(Enums.Defaults["TIMESTAMP_FORMAT"])
 
-        query_result = query(input_data, properties)
+        try:
+            query_result = query(input_data, properties)
+        except BaseException:
+            release_driver(properties, broken=True)
+            raise
+        else:
+            release_driver(properties)
         print (f"Execution Result: {json.dumps(query_result)}")
 
         if not isinstance(query_result, dict):
@@ -83,6 +96,12 @@ def hydra_tester(query_file_name):
     def hydra_test_loader(test_function):
         my_test_properties = Utils.load_parameters(query_file_name)
         def tester_wrapper():
-            test_function(my_test_properties)
+            try:
+                test_function(my_test_properties)
+            except BaseException:
+                release_driver(my_test_properties, broken=True)
+                raise
+            else:
+                release_driver(my_test_properties)
         return tester_wrapper
     return hydra_test_loader
\ No newline at end of file
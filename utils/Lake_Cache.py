@@ -0,0 +1,175 @@
+"""
+This module provides the result cache of Hydra queries: an in-memory LRU with per-entry expiry, optionally backed by
+an on-disk store shared between runs and processes.
+
+Keys are tuples of strings, e.g. the `(cpf, cep)` of a lookup. Values must be JSON serializable when a disk store is
+used. An entry stored with `ttl=NO_EXPIRY` never expires, which suits results that cannot change anymore.
+
+Hits and misses are counted by the cache (see :func:`ResultCache.stats`) and in the default
+:mod:`.Lake_Metrics` registry, as the `result_cache_hits` and `result_cache_misses` events.
+
+:Usage:
+    >>> import utils.Lake_Cache as Cache
+    >>> cache = Cache.ResultCache(max_entries=1024, ttl=300, disk_dir="/tmp/pes014_cache")
+    >>> result = cache.get(("06908488462", "50950005"))
+    >>> if result is None:
+    >>>     result = query(input_data)
+    >>>     cache.put(("06908488462", "50950005"), result)
+    >>> print(cache.stats()["hit_rate"])
+"""
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+import collections
+
+from . import Lake_Metrics as Metrics
+
+NO_EXPIRY = float("inf")
+
+
+def _key_string(key):
+    return "|".join(str(part) for part in key)
+
+
+class DiskStore():
+    """
+    One JSON file per entry inside `directory`. Writes are atomic, so several processes can share the directory
+
+    :param directory: Directory of the entries, created if missing
+    :type directory: str
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(_key_string(key).encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, key):
+        """:returns: tuple (expires_at, value) or None if the entry is missing or unreadable"""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != _key_string(key):
+            return None
+        expires_at = entry["expires_at"] if entry["expires_at"] is not None else NO_EXPIRY
+        return expires_at, entry["value"]
+
+    def store(self, key, expires_at, value):
+        path = self._path(key)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as entry_file:
+            json.dump({"key": _key_string(key), "expires_at": expires_at if expires_at != NO_EXPIRY else None,
+                       "value": value}, entry_file, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class ResultCache():
+    """
+    Thread safe LRU cache with per-entry expiry
+
+    :param max_entries: Maximum number of entries kept in memory. The least recently used entry is evicted first
+    :type max_entries: int
+    :param ttl: Default lifetime of an entry in seconds
+    :type ttl: float
+    :param disk_dir: (optional) Directory of an on-disk store consulted on memory misses. Entries evicted from memory stay on disk
+    :type disk_dir: str
+    """
+    def __init__(self, max_entries=1024, ttl=300.0, disk_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = DiskStore(disk_dir) if disk_dir else None
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+                         "stores": 0}
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _remember(self, key, expires_at, value):
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def get(self, key):
+        """
+        :param key: tuple identifying the entry
+        :type key: tuple
+
+        :returns: a copy of the cached value, or None if it is missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    self.counters["memory_hits"] += 1
+                    Metrics.increment("result_cache_hits")
+                    return copy.deepcopy(entry[1])
+                del self.entries[key]
+                self.counters["expired"] += 1
+
+        entry = self.disk.load(key) if self.disk is not None else None
+        if entry is not None:
+            if entry[0] > now:
+                self._remember(key, entry[0], entry[1])
+                self._count("hits")
+                self._count("disk_hits")
+                Metrics.increment("result_cache_hits")
+                return copy.deepcopy(entry[1])
+            self.disk.delete(key)
+            self._count("expired")
+
+        self._count("misses")
+        Metrics.increment("result_cache_misses")
+        return None
+
+    def put(self, key, value, ttl=None):
+        """
+        :param key: tuple identifying the entry
+        :type key: tuple
+        :param value: The value to cache, JSON serializable when a disk store is used
+        :param ttl: (optional) Lifetime of this entry in seconds, the cache `ttl` by default. `NO_EXPIRY` keeps it forever
+        :type ttl: float
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl != NO_EXPIRY else NO_EXPIRY
+        value = copy.deepcopy(value)
+        self._remember(key, expires_at, value)
+        if self.disk is not None:
+            self.disk.store(key, expires_at, value)
+        self._count("stores")
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        """Returns the hit, miss, expiry and eviction counters, the hit rate and the number of entries in memory"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["miss_rate"] = stats["misses"] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,71 @@
+"""
+This module defers the import of heavy dependencies until they are used, so that short-lived Hydra workers do not pay
+for modules a run never touches (cv2 and numpy for the captcha, selenium for the webdriver, ...).
+
+:func:`lazy_import` returns a placeholder bound like a regular import. The real module is imported by the first
+attribute access, and import errors are raised at that point.
+
+:Usage:
+    >>> import utils.Lake_Imports as Imports
+    >>> cv2 = Imports.lazy_import("cv2")                                  # import cv2
+    >>> np = Imports.lazy_import("numpy")                                 # import numpy as np
+    >>> lxml = Imports.lazy_import("lxml", submodules=("html", "etree"))  # import lxml.html, lxml.etree
+    >>> image = cv2.imread("catpchar.png")                                # cv2 is imported here
+"""
+import sys
+import importlib
+import threading
+
+
+class LazyModule():
+    """
+    Placeholder of a module imported on first attribute access
+
+    :param name: Name of the module
+    :type name: str
+    :param submodules: Submodules imported along with it, reachable as attributes like after `import name.submodule`
+    :type submodules: tuple
+    """
+    def __init__(self, name, submodules=()):
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_submodules"] = tuple(submodules)
+        self.__dict__["_lazy_module"] = None
+        self.__dict__["_lazy_lock"] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with self.__dict__["_lazy_lock"]:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    name = self.__dict__["_lazy_name"]
+                    module = importlib.import_module(name)
+                    for submodule in self.__dict__["_lazy_submodules"]:
+                        importlib.import_module(f"{name}.{submodule}")
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__dict__['_lazy_name']}' ({state})>"
+
+
+def lazy_import(name, submodules=()):
+    """Returns the module `name` if it is already imported, a :class:`LazyModule` placeholder otherwise"""
+    if name in sys.modules and all(f"{name}.{submodule}" in sys.modules for submodule in submodules):
+        return sys.modules[name]
+    return LazyModule(name, submodules)
+
+
+def is_loaded(module):
+    """True when `module` is a real module or a placeholder whose module was already imported"""
+    return not isinstance(module, LazyModule) or module.__dict__["_lazy_module"] is not None
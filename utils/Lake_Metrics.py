@@ -0,0 +1,197 @@
+"""
+This module collects the execution metrics of a Hydra query: latency histograms of the query stages, event counters and gauges.
+Everything is aggregated in memory by a :class:`MetricsRegistry` and can be dumped as JSON or as Prometheus text at the end of a run.
+
+:Usage:
+    >>> import utils.Lake_Metrics as Metrics
+    >>> with Metrics.span("start_page"):
+    >>>     response = session.get(start_url)
+    >>> Metrics.increment("captcha_rejections")
+    >>> Metrics.dump("metrics.prom")
+"""
+import json
+import time
+import threading
+import contextlib
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_HISTOGRAM = "hydra_stage_duration_seconds"
+EVENT_COUNTER = "hydra_events_total"
+
+
+class Histogram():
+    """
+    Cumulative histogram of observations
+
+    :param buckets: Upper bounds of the buckets, in increasing order
+    :type buckets: tuple
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile (the maximum if it falls over the last bucket)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, cumulative in zip(self.buckets, self.cumulative_counts()):
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(b) for b in self.buckets], self.cumulative_counts())),
+        }
+
+
+def _label_string(labels):
+    return ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+
+def _series(name, labels):
+    return f"{name}{{{_label_string(labels)}}}" if labels else name
+
+
+class MetricsRegistry():
+    """Thread safe store of counters, gauges and histograms, identified by a metric name and a set of labels"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Times the enclosed block into the stage latency histogram. Failed blocks are recorded with `outcome="error"`"""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(STAGE_HISTOGRAM, time.perf_counter() - start, stage=stage, outcome=outcome)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [dict({"name": name, "labels": dict(labels)}, **histogram.as_dict())
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{_series(name, labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} gauge")
+                    typed.add(name)
+                lines.append(f"{_series(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                prefix = _label_string(labels) + "," if labels else ""
+                for bound, cumulative in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+                lines.append(f"{_series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Writes the metrics to `path`, as Prometheus text if it ends with `.prom`, as JSON otherwise"""
+        with open(path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus() if path.endswith(".prom") else self.to_json())
+        return path
+
+
+REGISTRY = MetricsRegistry()
+
+
+def span(stage):
+    """Times a query stage in the default registry, see :func:`MetricsRegistry.span`"""
+    return REGISTRY.span(stage)
+
+
+def increment(event, amount=1):
+    """Increments an event counter of the default registry"""
+    REGISTRY.increment(EVENT_COUNTER, amount, event=event)
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge of the default registry"""
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def dump(path):
+    """Dumps the default registry, see :func:`MetricsRegistry.dump`"""
+    return REGISTRY.dump(path)
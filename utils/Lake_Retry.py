@@ -0,0 +1,114 @@
+"""
+This module provides the retry policy shared by Hydra queries: jittered exponential backoff, per-attempt timeouts
+and an overall deadline, usually the `timeout` declared in the query HydraMetadata.
+
+Failures are classified with the :mod:`.Lake_Exceptions` types. By default an attempt raising
+:class:`.Lake_Exceptions.HttpTimeoutException` or :class:`.Lake_Exceptions.BlockException` is retried, and any other
+exception is raised right away. When the deadline is over, :class:`.Lake_Exceptions.HttpTimeoutException` is raised.
+
+:Usage:
+    >>> import utils.Lake_Retry as Retry
+    >>> import utils.Lake_Exceptions as Exceptions
+    >>> deadline = Retry.Deadline(15)
+    >>> def attempt(timeout):
+    >>>     response = session.get(url, timeout=timeout)
+    >>>     if response.status_code != 200:
+    >>>         raise Exceptions.BlockException("Host answered " + str(response.status_code))
+    >>>     return response
+    >>> response = Retry.RetryPolicy().run(attempt, deadline, "start page")
+"""
+import time
+import random
+
+from . import Lake_Exceptions as Exceptions
+
+
+class Deadline():
+    """
+    Point in time after which an operation must give up
+
+    :param seconds: Seconds from now until the deadline. None means no deadline
+    :type seconds: float
+    """
+    def __init__(self, seconds=None):
+        self.seconds = float(seconds) if seconds is not None else None
+        self.expires_at = time.monotonic() + self.seconds if seconds is not None else None
+
+    def remaining(self):
+        """Seconds left until the deadline, None if there is no deadline"""
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self, description):
+        """Raises :class:`.Lake_Exceptions.HttpTimeoutException` if the deadline is over"""
+        if self.expired():
+            raise Exceptions.HttpTimeoutException(f"Deadline of {self.seconds}s exceeded during: {description}")
+
+
+class RetryPolicy():
+    """
+    Retries an operation with jittered exponential backoff
+
+    :param max_attempts: Maximum number of attempts
+    :type max_attempts: int
+    :param base_delay: Backoff before the second attempt, doubled after every failure
+    :type base_delay: float
+    :param max_delay: Upper bound of a single backoff
+    :type max_delay: float
+    :param attempt_timeout: Upper bound in seconds given to each attempt, always capped by the time left until the deadline
+    :type attempt_timeout: float
+    :param retry_on: Exception types that trigger a new attempt
+    :type retry_on: tuple
+    """
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=8.0, attempt_timeout=10.0,
+                 retry_on=(Exceptions.HttpTimeoutException, Exceptions.BlockException)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.retry_on = retry_on
+
+    def backoff(self, failures):
+        """Full jitter backoff after `failures` failed attempts"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failures - 1)))
+
+    def attempt_timeout_for(self, deadline):
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is None:
+            return self.attempt_timeout
+        if self.attempt_timeout is None:
+            return remaining
+        return min(self.attempt_timeout, remaining)
+
+    def run(self, attempt, deadline=None, description="operation"):
+        """
+        Calls `attempt(timeout)` until it succeeds, the attempts are over or the deadline expires
+
+        :param attempt: function receiving the timeout in seconds of the current attempt
+        :type attempt: function
+        :param deadline: (optional) The overall deadline
+        :type deadline: Deadline
+        :param description: Used in the exception messages
+        :type description: str
+
+        :returns: the value returned by `attempt`
+        """
+        deadline = deadline or Deadline()
+        failures = 0
+        while True:
+            deadline.check(description)
+            try:
+                return attempt(self.attempt_timeout_for(deadline))
+            except self.retry_on as error:
+                failures += 1
+                if failures >= self.max_attempts:
+                    raise
+                delay = self.backoff(failures)
+                remaining = deadline.remaining()
+                if remaining is not None and delay >= remaining:
+                    raise Exceptions.HttpTimeoutException(f"Deadline of {deadline.seconds}s exceeded during: {description} (last error: {error})")
+                time.sleep(delay)
@@ -0,0 +1,161 @@
+"""
+This module adapts the number of concurrent HTTP calls a Hydra query sends to each host, with an AIMD
+(additive increase, multiplicative decrease) controller.
+
+Every call holds a slot of its host while it runs. The limit of slots grows by about one per `limit` healthy replies
+and is multiplied by `decrease_factor` when the host shows signs of blocking: a :class:`.Lake_Exceptions.BlockException`
+(non 200 answer, refused connection), a :class:`.Lake_Exceptions.HttpTimeoutException` or a reply slower than
+`slow_threshold`. Only calls started after the last decrease can shrink the limit again, so a burst of failures of
+the same window counts as one signal.
+
+The current limit, the calls in flight and the achieved request rate of every host are published as gauges of the
+default :mod:`.Lake_Metrics` registry.
+
+:Usage:
+    >>> import utils.Lake_Throttle as Throttle
+    >>> controller = Throttle.AimdController(initial_limit=4, max_limit=32)
+    >>> with controller.slot("http://tracking.totalexpress.com.br/tracking/0", timeout=10) as remaining:
+    >>>     response = session.get(url, timeout=remaining)
+    >>> print(controller.stats())
+"""
+import time
+import threading
+import contextlib
+import collections
+import urllib.parse
+
+from . import Lake_Exceptions as Exceptions
+from . import Lake_Metrics as Metrics
+
+LIMIT_GAUGE = "hydra_host_concurrency_limit"
+IN_FLIGHT_GAUGE = "hydra_host_requests_in_flight"
+RATE_GAUGE = "hydra_host_request_rate"
+
+
+class HostState():
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.completions = collections.deque()
+        self.condition = threading.Condition()
+
+
+class AimdController():
+    """
+    Per host AIMD limit of concurrent calls
+
+    :param initial_limit: Limit of a host before its first reply
+    :type initial_limit: float
+    :param min_limit: Lower bound of the limit
+    :type min_limit: float
+    :param max_limit: Upper bound of the limit
+    :type max_limit: float
+    :param decrease_factor: Multiplier applied to the limit on a blocking signal
+    :type decrease_factor: float
+    :param slow_threshold: Seconds after which a successful reply counts as a blocking signal
+    :type slow_threshold: float
+    :param rate_window: Seconds over which the achieved request rate is measured
+    :type rate_window: float
+    """
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32, decrease_factor=0.5, slow_threshold=5.0,
+                 rate_window=10.0):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.slow_threshold = slow_threshold
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _host_state(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(self.initial_limit)
+            return self.hosts[host]
+
+    def _publish(self, host, state, now):
+        while state.completions and state.completions[0] < now - self.rate_window:
+            state.completions.popleft()
+        Metrics.set_gauge(LIMIT_GAUGE, state.limit, host=host)
+        Metrics.set_gauge(IN_FLIGHT_GAUGE, state.in_flight, host=host)
+        Metrics.set_gauge(RATE_GAUGE, len(state.completions) / self.rate_window, host=host)
+
+    def acquire(self, host, timeout=None):
+        """Waits for a free slot of `host`
+
+        :returns: the time the slot was taken, to be given back to :func:`release`
+        """
+        state = self._host_state(host)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with state.condition:
+            while state.in_flight >= int(state.limit):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise Exceptions.HttpTimeoutException(f"No free slot for {host} within {timeout}s")
+                state.condition.wait(remaining)
+            state.in_flight += 1
+            started = time.monotonic()
+            self._publish(host, state, started)
+        return started
+
+    def release(self, host, started, healthy):
+        """Frees a slot of `host` and adapts its limit
+
+        :param started: The value returned by :func:`acquire`
+        :type started: float
+        :param healthy: True for a timely successful reply, False for a blocking signal, None to leave the limit unchanged
+        :type healthy: bool
+        """
+        state = self._host_state(host)
+        now = time.monotonic()
+        with state.condition:
+            state.in_flight -= 1
+            state.completions.append(now)
+            if healthy:
+                state.limit = min(self.max_limit, state.limit + 1.0 / state.limit)
+            elif healthy is False and started >= state.last_decrease:
+                state.limit = max(self.min_limit, state.limit * self.decrease_factor)
+                state.last_decrease = now
+                Metrics.increment("host_block_signals")
+            self._publish(host, state, now)
+            state.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, url, timeout=None):
+        """Holds a slot of the host of `url` while the enclosed call runs. The outcome of the call adapts the limit
+
+        :returns: the part of `timeout` left after waiting for the slot, to be given to the enclosed call (None without timeout)
+        """
+        host = urllib.parse.urlsplit(url).netloc or url
+        waiting = time.monotonic()
+        started = self.acquire(host, timeout)
+        remaining = None
+        if timeout is not None:
+            remaining = timeout - (started - waiting)
+            if remaining <= 0:
+                self.release(host, started, None)
+                raise Exceptions.HttpTimeoutException(f"No time left for {host} after waiting {timeout}s for a slot")
+        healthy = None
+        try:
+            yield remaining
+            healthy = time.monotonic() - started <= self.slow_threshold
+        except (Exceptions.BlockException, Exceptions.HttpTimeoutException):
+            healthy = False
+            raise
+        finally:
+            self.release(host, started, healthy)
+
+    def stats(self):
+        """Returns the limit, calls in flight and request rate (calls/sec) of every host"""
+        now = time.monotonic()
+        with self.lock:
+            hosts = dict(self.hosts)
+        stats = {}
+        for host, state in hosts.items():
+            with state.condition:
+                recent = sum(1 for completion in state.completions if completion >= now - self.rate_window)
+                stats[host] = {"limit": state.limit, "in_flight": state.in_flight,
+                               "request_rate": recent / self.rate_window}
+        return stats
@@ -0,0 +1,169 @@
+"""
+This module provides the process-wide HTTP transport of Hydra queries: one pool of keep-alive connections shared by
+every `requests` session of the process.
+
+A session created by :func:`new_session` keeps its own cookies and headers, so lookups stay isolated from each other,
+but its requests go through the shared :class:`SharedHTTPAdapter`. The TCP (and TLS) connections opened by a lookup
+are therefore reused by the next lookups to the same host instead of being connected again. Closing such a session
+does not close the shared connections, :func:`close_transport` does.
+
+Every new connection is timed, which gives the connection reuse ratio and an estimate of the connect time saved by
+the reuse (see :func:`transport_stats`). The counts are also published as the `http_requests` and
+`connections_opened` events of the default :mod:`.Lake_Metrics` registry.
+
+:Usage:
+    >>> import utils.Lake_Transport as Transport
+    >>> session = Transport.new_session({"User-Agent": "Mozilla/5.0"})
+    >>> response = session.get("http://tracking.totalexpress.com.br/tracking/0")
+    >>> session.close()
+    >>> print(Transport.transport_stats()["reuse_ratio"])
+"""
+import os
+import time
+import threading
+
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+
+from . import Lake_Metrics as Metrics
+
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 64
+
+
+class TransportStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+        Metrics.increment("http_requests")
+
+    def record_connect(self, elapsed):
+        with self.lock:
+            self.connections += 1
+            self.connect_time += elapsed
+        Metrics.increment("connections_opened")
+        Metrics.REGISTRY.observe(Metrics.STAGE_HISTOGRAM, elapsed, stage="tcp_connect", outcome="ok")
+
+    def as_dict(self):
+        with self.lock:
+            requests_sent, connections, connect_time = self.requests, self.connections, self.connect_time
+        mean_connect_time = connect_time / connections if connections else 0.0
+        reused = max(requests_sent - connections, 0)
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections,
+            "reuse_ratio": reused / requests_sent if requests_sent else 0.0,
+            "connect_time": connect_time,
+            "mean_connect_time": mean_connect_time,
+            "estimated_connect_time_saved": reused * mean_connect_time,
+        }
+
+
+STATS = TransportStats()
+
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        STATS.record_connect(time.perf_counter() - start)
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        STATS.record_connect(time.perf_counter() - start)
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class SharedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter meant to be mounted on many sessions. `close()` is a no-op so that closing one session keeps the
+    connections of the others, :func:`close_transport` closes them for good
+
+    :param pool_connections: Number of hosts whose connection pools are kept
+    :type pool_connections: int
+    :param pool_maxsize: Number of idle keep-alive connections kept per host
+    :type pool_maxsize: int
+    """
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
+
+    def send(self, request, **kwargs):
+        STATS.record_request()
+        return super().send(request, **kwargs)
+
+    def close(self):
+        pass
+
+    def close_shared(self):
+        super().close()
+
+
+_transport = None
+_transport_pid = None
+_transport_lock = threading.Lock()
+
+
+def get_transport(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Returns the shared adapter of the process, created by the first call. A forked child gets its own adapter instead of the connections of its parent"""
+    global _transport, _transport_pid
+    with _transport_lock:
+        if _transport is None or _transport_pid != os.getpid():
+            _transport = SharedHTTPAdapter(pool_connections, pool_maxsize)
+            _transport_pid = os.getpid()
+        return _transport
+
+
+def new_session(headers=None, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Creates a session with its own cookies and headers sending its requests through the shared transport
+
+    :param headers: (optional) Headers sent with every request of the session, merged with the `requests` defaults
+    :type headers: dict
+    :param pool_maxsize: Idle connections kept per host, only used by the call creating the shared transport
+    :type pool_maxsize: int
+
+    :returns: requests.Session
+    """
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    transport = get_transport(pool_maxsize=pool_maxsize)
+    session.mount("http://", transport)
+    session.mount("https://", transport)
+    return session
+
+
+def close_transport():
+    """Closes every connection of the shared transport"""
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close_shared()
+            _transport = None
+
+
+def transport_stats():
+    """Returns the requests sent, the connections opened, the connection reuse ratio and the connect time spent and saved"""
+    return STATS.as_dict()
@@ -1,7 +1,6 @@
 import time
 import string
 import random
-import urllib.request, urllib.error, urllib.parse
 import re #regular expression library
 from datetime import datetime
 import os
@@ -11,12 +10,18 @@ import hashlib
 from unicodedata import normalize
 import bz2
 import base64
-import lxml
-from lxml.html.clean import Cleaner
-from selenium import webdriver
+import atexit
+import threading
+import contextlib
 
 from . import Lake_Exceptions as Exceptions
 from . import Lake_Enum as Enums
+from . import Lake_Imports as Imports
+
+# Imported on first use, see :mod:`.Lake_Imports`
+lxml = Imports.lazy_import("lxml", submodules=("html", "html.clean"))
+webdriver = Imports.lazy_import("selenium.webdriver")
+urllib = Imports.lazy_import("urllib", submodules=("request", "error", "parse"))
 
 
 def random_identifier(size=5):
@@ -365,7 +370,7 @@ def clean_html(html_text,
 
     """
     # True = Remove | False = Keep
-    cleaner = Cleaner()
+    cleaner = lxml.html.clean.Cleaner()
     cleaner.javascript = javascript  # This is True because we want to activate the javascript filter
     cleaner.scripts = scripts  # This is True because we want to activate the scripts filter
     cleaner.style = style
@@ -390,7 +395,7 @@ def load_parameters(file_name):
     :param file_name: The name of the Hydra query. This method will open the file and load the `<#@#HydraMetadata#@#>` section in the begining of the file.
     :type file_name: str
 
-    :returns: A dictionary containing the execution properties for your query and, if needed, a working webdriver.
+    :returns: A dictionary containing the execution properties for your query and, if needed, a working webdriver. The webdriver is a :class:`LazyWebDriver`, Chrome only starts when your query first uses it.
 
     .. note:: This method is used internally by our architecture when your query is being tested in order to simulate our architecture standard behavior. You don't need to worry about it nor use it in your query implementation. Just make sure to use the correct decorators :func:`.hydra_query` and :func:`.hydra_tester`
     """
@@ -414,18 +419,244 @@ def load_parameters(file_name):
         query_properties = {"timeout":int(Enums.environ_variables['timeout'])}
 
         if Enums.environ_variables['selenium_usage'] == "true":
-            from selenium.webdriver.chrome.options import Options
-            chrome_options = Options()
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument('--no-sandbox')
-            chrome_options.add_argument('--disable-dev-shm-usage')
-            if ('chromedriver' in os.listdir('/usr/local/bin')) or ('chromedriver' in os.listdir('/usr/local/bin')):
-                driver = webdriver.Chrome(options=chrome_options)
-                query_properties['driver'] = driver
-            elif os.path.isfile('./chromedriver'):
-                driver = webdriver.Chrome(executable_path='./chromedriver',options=chrome_options)
-                query_properties['driver'] = driver
-            else:
-                raise Exception("CHROME DRIVER NOT FOUND: Please download the chromedriver and place it on the hydra root directory")
+            query_properties['driver'] = LazyWebDriver()
+
+        return query_properties
+
+
+def start_chrome_driver():
+    """
+    Starts a headless Chrome webdriver, using the chromedriver of `/usr/local/bin` or of the hydra root directory
+
+    :returns: selenium.webdriver.Chrome
+    """
+    from selenium.webdriver.chrome.options import Options
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    if ('chromedriver' in os.listdir('/usr/local/bin')) or ('chromedriver' in os.listdir('/usr/local/bin')):
+        return webdriver.Chrome(options=chrome_options)
+    elif os.path.isfile('./chromedriver'):
+        return webdriver.Chrome(executable_path='./chromedriver',options=chrome_options)
+    else:
+        raise Exception("CHROME DRIVER NOT FOUND: Please download the chromedriver and place it on the hydra root directory")
+
+
+class WebDriverPool():
+    """
+    Bounded pool of webdrivers leased to queries. A driver is reset (cookies, local and session storage cleared) when it comes back, health checked before every lease and quit after `max_uses` leases, so the number of browsers and their memory stay flat under sustained load
+
+    :param size: Maximum number of browsers alive at the same time
+    :type size: int
+    :param max_uses: Number of leases after which a browser is quit and replaced
+    :type max_uses: int
+    :param factory: Function starting a new webdriver
+    :type factory: function
+
+    :Usage:
+        >>> pool = Utils.WebDriverPool(size=2, max_uses=50)
+        >>> with pool.lease() as driver:
+        >>>     driver.get(target_host)
+        >>> pool.close()
+    """
+    def __init__(self, size=2, max_uses=50, factory=start_chrome_driver):
+        self.size = size
+        self.max_uses = max_uses
+        self.factory = factory
+        self.condition = threading.Condition()
+        self.idle = []
+        self.uses = {}
+        self.closed = False
+        self.stats = {"leases": 0, "created": 0, "recycled": 0, "health_check_failures": 0, "reset_failures": 0}
+
+    def _quit(self, driver):
+        """Quits a browser outside of the lock, then frees its slot"""
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self.condition:
+            self.uses.pop(id(driver), None)
+            self.condition.notify_all()
+
+    def _is_healthy(self, driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Leases a driver, starting a new browser when none is idle and the pool is not full
+
+        :param timeout: (optional) Seconds to wait for a driver when every browser is leased
+        :type timeout: float
+
+        :returns: a webdriver, to be given back with :func:`release`
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise Exceptions.CriticalErrorException("The webdriver pool is closed")
+                    if self.idle:
+                        driver = self.idle.pop()
+                        break
+                    if len(self.uses) < self.size:
+                        # Reserves the slot while the browser starts outside of the lock
+                        driver = None
+                        placeholder = object()
+                        self.uses[id(placeholder)] = 0
+                        break
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise Exceptions.HttpTimeoutException(f"No webdriver available within {timeout}s")
+                    self.condition.wait(remaining)
+            if driver is None:
+                return self._start(placeholder)
+            # The health check talks to the browser, so it runs outside of the lock. The driver keeps its slot meanwhile
+            if self._is_healthy(driver):
+                with self.condition:
+                    self.stats["leases"] += 1
+                return driver
+            with self.condition:
+                self.stats["health_check_failures"] += 1
+            self._quit(driver)
+
+    def _start(self, placeholder):
+        """Starts a browser in the slot reserved by `placeholder`"""
+        try:
+            driver = self.factory()
+        except BaseException:
+            with self.condition:
+                del self.uses[id(placeholder)]
+                self.condition.notify_all()
+            raise
+        # The driver takes over the slot of the placeholder in one step, so no other lease can start a browser meanwhile
+        with self.condition:
+            del self.uses[id(placeholder)]
+            self.uses[id(driver)] = 0
+            self.stats["created"] += 1
+            self.stats["leases"] += 1
+        return driver
+
+    def _reset(self, driver):
+        driver.delete_all_cookies()
+        driver.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+        driver.get("about:blank")
+
+    def release(self, driver, broken=False):
+        """
+        Gives a leased driver back. It is reset for the next query, or quit if it is broken or used `max_uses` times
+
+        :param broken: The query saw the browser misbehave, quit it instead of reusing it
+        :type broken: bool
+        """
+        with self.condition:
+            uses = self.uses.get(id(driver), 0) + 1
+            self.uses[id(driver)] = uses
+        if not broken and not self.closed and uses < self.max_uses:
+            try:
+                self._reset(driver)
+            except Exception:
+                broken = True
+                with self.condition:
+                    self.stats["reset_failures"] += 1
+        with self.condition:
+            retire = broken or self.closed or uses >= self.max_uses
+            if not retire:
+                self.idle.append(driver)
+                self.condition.notify_all()
+            elif uses >= self.max_uses:
+                self.stats["recycled"] += 1
+        if retire:
+            self._quit(driver)
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """Leases a driver for the enclosed block. The driver is quit instead of reused when the block raises"""
+        driver = self.acquire(timeout)
+        broken = False
+        try:
+            yield driver
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self.release(driver, broken)
+
+    def close(self):
+        """Quits the idle browsers. Leased ones are quit when they are released"""
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.condition.notify_all()
+        for driver in idle:
+            self._quit(driver)
+
+
+_webdriver_pool = None
+_webdriver_pool_lock = threading.Lock()
+
+
+def get_webdriver_pool():
+    """
+    Returns the webdriver pool of the process, created on first use. Its size and recycling are read from the `webdriver_pool_size` (default 2) and `webdriver_max_uses` (default 50) entries of :data:`.Lake_Enum.environ_variables`, so they can be set in the HydraMetadata. Its browsers are quit when the process exits
+    """
+    global _webdriver_pool
+    with _webdriver_pool_lock:
+        if _webdriver_pool is None:
+            _webdriver_pool = WebDriverPool(size=int(Enums.environ_variables.get('webdriver_pool_size', 2)),
+                                            max_uses=int(Enums.environ_variables.get('webdriver_max_uses', 50)))
+            atexit.register(_webdriver_pool.close)
+        return _webdriver_pool
+
+
+class LazyWebDriver():
+    """
+    Webdriver leased from a :class:`WebDriverPool` by the first access to one of its attributes, so that queries declaring `"selenium_usage":"true"` without using `properties['driver']` never boot a browser
+
+    :param pool: (optional) The pool leasing the driver. The process pool of :func:`get_webdriver_pool` by default
+    :type pool: WebDriverPool
 
-        return query_properties
\ No newline at end of file
+    :Usage:
+        >>> driver = Utils.LazyWebDriver()
+        >>> driver.get(target_host)  # A browser is leased here
+        >>> driver.release()         # and given back to the pool, the next access leases one again
+
+    .. note:: A missing chromedriver is reported by the first use of the driver, not by :func:`load_parameters`
+    """
+    def __init__(self, pool=None):
+        self.__dict__["_pool"] = pool
+        self.__dict__["_driver"] = None
+
+    @property
+    def started(self):
+        return self.__dict__["_driver"] is not None
+
+    def _get_driver(self):
+        if self.__dict__["_driver"] is None:
+            pool = self.__dict__["_pool"] or get_webdriver_pool()
+            self.__dict__["_pool"] = pool
+            self.__dict__["_driver"] = pool.acquire()
+        return self.__dict__["_driver"]
+
+    def __getattr__(self, attribute):
+        return getattr(self._get_driver(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._get_driver(), attribute, value)
+
+    def release(self, broken=False):
+        """Gives the leased browser back to the pool, if one was leased"""
+        driver = self.__dict__["_driver"]
+        if driver is not None:
+            self.__dict__["_driver"] = None
+            self.__dict__["_pool"].release(driver, broken)
+
+    def quit(self):
+        """Gives the browser back to the pool, which keeps it for the next query or quits it"""
+        self.release()